@@ -0,0 +1,238 @@
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridOut, AsyncIOMotorGridIn
+from bson.objectid import ObjectId
+from pymongo.collation import Collation
+from PIL import Image
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import asyncio
+import time
+import os
+
+from cache import LRUByteCache
+from variants import render_image, image_width, variant_width
+from db import LumaDB, MediaFile, guess_media_type, STREAM_BUFFER_SIZE, MEDIA_CACHE_SIZE, MEDIA_CACHE_MAX_ITEM_SIZE, \
+    SERVICED_LANGUAGE, create_indexes
+
+# seconds between two reads of the version documents, a write shows up in the API at most this late
+VERSION_CHECK_INTERVAL = float(os.getenv("VERSION_CHECK_INTERVAL", 5))
+
+
+class AsyncMediaFile(MediaFile):
+    def open(self) -> AsyncIOMotorGridOut:
+        # a fresh handle per caller, built from the already fetched files document
+        return AsyncIOMotorGridOut(self.root_collection, file_document=self.file_document)
+
+
+class AsyncLumaDB:
+    # read side of LumaDB on Motor for the API handlers, writes keep using the synchronous LumaDB
+    def __init__(self, mongo_client_param: AsyncIOMotorClient = None,
+                 version_check_interval: float = VERSION_CHECK_INTERVAL) -> None:
+        if mongo_client_param is None:
+            mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
+            self.mongo_client = AsyncIOMotorClient(mongo_uri)
+        else:
+            self.mongo_client = mongo_client_param
+        self.db = self.mongo_client.luma
+
+        self.palace_db = self.db.palaces
+        self.building_view_db = self.db.building_views
+        self.media_meta_db = self.db.media_meta
+        self.media_cache = LRUByteCache(MEDIA_CACHE_SIZE, MEDIA_CACHE_MAX_ITEM_SIZE)
+        # variants being rendered on demand, concurrent requests for the same one wait for a single render
+        self._rendering = {}
+
+        # version id -> callbacks run with the new version, and the version they last saw
+        self._version_callbacks = {}
+        self._versions = {}
+        self._version_check_interval = version_check_interval
+        self._next_version_check = 0.0
+        self._version_lock = asyncio.Lock()
+
+    async def ensure_indexes(self) -> None:
+        # run by the API at startup, on the pymongo database underneath Motor so LumaDB shares one implementation
+        await asyncio.get_running_loop().run_in_executor(None, create_indexes, self.db.delegate)
+
+    def on_version_change(self, version_id: str, callback: Callable[[int], Awaitable[None]]) -> None:
+        # version_id is a document of luma.content_version, e.g. CONTENT_VERSION_ID
+        self._version_callbacks.setdefault(version_id, []).append(callback)
+
+    async def check_versions(self) -> None:
+        # one query for every watched version per interval, the first call runs every callback
+        now = time.monotonic()
+        if now < self._next_version_check:
+            return
+        async with self._version_lock:
+            if now < self._next_version_check:
+                return
+            self._next_version_check = now + self._version_check_interval
+            states = self.db.content_version.find({"_id": {"$in": list(self._version_callbacks)}})
+            versions = {state["_id"]: state["version"] async for state in states}
+            for version_id, callbacks in self._version_callbacks.items():
+                version = versions.get(version_id, 0)
+                if version != self._versions.get(version_id):
+                    self._versions[version_id] = version
+                    for callback in callbacks:
+                        await callback(version)
+
+    async def _find_media(self, bucket_name: str, entry_id, default_content_type: Optional[str] = None,
+                          query: Optional[dict] = None, sort: Optional[list] = None) -> Optional[AsyncMediaFile]:
+        # entry_id is the cache key, the files document is looked up by query when it isn't the _id
+        cached = self.media_cache.get((bucket_name, entry_id))
+        if cached is not None:
+            return cached
+
+        root_collection = self.db[bucket_name]
+        file_document = await self.db[f"{bucket_name}.files"].find_one(query or {"_id": entry_id}, sort=sort)
+        if not file_document:
+            return None
+
+        content_type = file_document.get("contentType") or guess_media_type(file_document.get("url"))
+        media = AsyncMediaFile(root_collection, file_document, content_type or default_content_type)
+        if media.length <= self.media_cache.max_item_size:
+            media.data = await media.open().read()
+        self.media_cache.put((bucket_name, entry_id), media, len(media.data or b"") + 512)
+        return media
+
+    async def find_file(self, media_id: ObjectId) -> Optional[AsyncMediaFile]:
+        return await self._find_media("images", media_id)
+
+    async def find_thumbnail(self, entry_id: ObjectId) -> Optional[AsyncMediaFile]:
+        return await self._find_media("thumbnails", entry_id, default_content_type="image/webp")
+
+    async def find_variant(self, image_id: ObjectId, width: int, fmt: str) -> Optional[AsyncMediaFile]:
+        # the narrowest stored variant at least width wide, width is one of VARIANT_WIDTHS
+        return await self._find_media("variants", (image_id, width, fmt), f"image/{fmt}",
+                                      {"image_id": image_id, "format": fmt, "width": {"$gte": width}},
+                                      sort=[("width", 1)])
+
+    async def save_variant(self, image_id: ObjectId, width: int, fmt: str, data: bytes) -> None:
+        grid_in = AsyncIOMotorGridIn(self.db.variants, image_id=image_id, width=width, format=fmt,
+                                     contentType=f"image/{fmt}")
+        await grid_in.write(data)
+        await grid_in.close()
+
+    async def find_or_render_variant(self, media: AsyncMediaFile, width: int,
+                                     fmt: str) -> Optional[AsyncMediaFile]:
+        # closest stored variant at or above width, rendered when missing; None means serve the original
+        width = variant_width(width)
+        variant = await self.find_variant(media.id, width, fmt)
+        if variant:
+            return variant
+        # known once the crawler or an earlier render decoded the image
+        original_width = media.file_document.get("width")
+        if original_width is not None and original_width <= width:
+            return None
+
+        key = (media.id, width, fmt)
+        rendering = self._rendering.get(key)
+        if rendering is None:
+            rendering = asyncio.ensure_future(self._render_variant(media, width, fmt))
+            self._rendering[key] = rendering
+            rendering.add_done_callback(lambda _: self._rendering.pop(key, None))
+        return await asyncio.shield(rendering)
+
+    async def _render_variant(self, media: AsyncMediaFile, width: int, fmt: str) -> Optional[AsyncMediaFile]:
+        data = media.data if media.data is not None else await media.open().read()
+        try:
+            original_width = image_width(data)
+            if original_width > width:
+                # decoding and encoding hold the CPU, keep them off the event loop
+                rendered = await asyncio.get_running_loop().run_in_executor(None, render_image, data, width, fmt)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"Failed to render variant of {media.id}: {e}")
+            return None
+        # the cached descriptor keeps it too, the next request doesn't read the image again
+        media.file_document["width"] = original_width
+        await self.db["images.files"].update_one({"_id": media.id}, {"$set": {"width": original_width}})
+        if original_width <= width:
+            return None
+        await self.save_variant(media.id, width, fmt, rendered)
+        return await self.find_variant(media.id, width, fmt)
+
+    @staticmethod
+    async def iter_file(media: AsyncMediaFile, start: int = 0, end: Optional[int] = None,
+                        buffer_size: int = STREAM_BUFFER_SIZE) -> AsyncIterator[bytes]:
+        # yield the inclusive byte range [start, end] of the file, at most buffer_size bytes at a time
+        if end is None or end >= media.length:
+            end = media.length - 1
+        buffer_size = max(buffer_size, media.chunk_size)
+
+        if media.data is not None:
+            body = memoryview(media.data)
+            for offset in range(start, end + 1, buffer_size):
+                yield bytes(body[offset:min(offset + buffer_size, end + 1)])
+            return
+
+        handle = media.open()
+        handle.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await handle.read(min(buffer_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    async def get_detailed_image(self, image_id: ObjectId, language: str) -> Optional[dict]:
+        result = await self.media_meta_db.find_one({"_id": image_id})
+        return LumaDB.detailed_image_mongo_to_dict(result, language)
+
+    async def get_detailed_video(self, video_id: ObjectId, language: str) -> Optional[dict]:
+        result = await self.media_meta_db.find_one({"_id": video_id})
+        return LumaDB.detailed_video_mongo_to_dict(result, language)
+
+    async def get_building(self, palace_id: ObjectId, language: str) -> Optional[dict]:
+        view = await self.building_view_db.find_one({"building_id": palace_id, "language": language},
+                                                    {"_id": 0, "building": 1})
+        if view:
+            return view["building"]
+
+        # views are written after the palace, read a building crawled since the last build directly
+        result = await self.palace_db.find_one({"_id": palace_id})
+        if result:
+            return LumaDB.building_mongo_to_dict(result, language)
+        else:
+            return None
+
+    async def get_building_from_slug(self, slug: str, language: str) -> Optional[dict]:
+        view = await self.building_view_db.find_one({"url_slug": slug, "language": language},
+                                                    {"_id": 0, "building": 1})
+        if view:
+            return view["building"]
+
+        result = await self.palace_db.find_one({"url_slug": slug})
+        if result:
+            return LumaDB.building_mongo_to_dict(result, language)
+        else:
+            return None
+
+    async def get_building_names(self) -> list[dict]:
+        return [palace async for palace in self.palace_db.find({}, {"name": 1})]
+
+    async def building_views_complete(self) -> bool:
+        # views of buildings crawled before they existed appear once tools/build_views.py ran
+        palaces = await self.palace_db.estimated_document_count()
+        views = await self.building_view_db.estimated_document_count()
+        return views == palaces * len(SERVICED_LANGUAGE)
+
+    async def get_sorted_elements(self, language: str, from_palaces: bool = False) -> list[dict]:
+        if from_palaces:
+            palaces = self.palace_db.find({}, {"palace_code": 1, "name": 1, "url_slug": 1},
+                                          collation=Collation(locale=language)).sort(f"name.{language}", 1)
+            return [{"palace_code": palace["palace_code"],
+                     "element": LumaDB.palace_element_mongo_to_dict({"url_slug": None, **palace}, language)}
+                    async for palace in palaces]
+
+        views = self.building_view_db.find({"language": language}, {"_id": 0, "palace_code": 1, "element": 1},
+                                           collation=Collation(locale=language)).sort("element.name", 1)
+        return [view async for view in views]
+
+    async def get_ordered_previews(self, language: str, from_palaces: bool = False) -> list[dict]:
+        if from_palaces:
+            palaces = self.palace_db.find({}, {"palace_code": 1, "name": 1, "url_slug": 1, "explanation": 1,
+                                               "thumbnail": 1})
+            return [{"palace_code": palace["palace_code"],
+                     "preview": LumaDB.building_mongo_to_preview({"url_slug": None, **palace}, language)}
+                    async for palace in palaces.sort([("palace_code", 1), ("detail_code", 1)])]
+
+        views = self.building_view_db.find({"language": language}, {"_id": 0, "palace_code": 1, "preview": 1})
+        return [view async for view in views.sort([("palace_code", 1), ("detail_code", 1)])]
@@ -0,0 +1,91 @@
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from typing import Iterator, Optional
+import threading
+import requests
+import random
+import time
+import os
+
+# seconds to connect and between two received bytes, a stalled server can't hold a crawler thread forever
+CRAWL_CONNECT_TIMEOUT = float(os.getenv("CRAWL_CONNECT_TIMEOUT", 5))
+CRAWL_READ_TIMEOUT = float(os.getenv("CRAWL_READ_TIMEOUT", 30))
+# requests in flight per host, also the number of pooled connections kept open to it
+CRAWL_CONNECTIONS_PER_HOST = int(os.getenv("CRAWL_CONNECTIONS_PER_HOST", 8))
+CRAWL_MAX_RETRIES = int(os.getenv("CRAWL_MAX_RETRIES", 4))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# answers that say "try again later" rather than "this doesn't exist"
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    # full jitter, threads that failed together don't come back together
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    header = response.headers.get("Retry-After", "")
+    return float(header) if header.isdigit() else None
+
+
+class CrawlSession(requests.Session):
+    # shared by every crawler thread and the kheritage clients, pooled, rate limited per host and retried
+    def __init__(self, connections_per_host: int = CRAWL_CONNECTIONS_PER_HOST, max_retries: int = CRAWL_MAX_RETRIES,
+                 timeout: tuple = (CRAWL_CONNECT_TIMEOUT, CRAWL_READ_TIMEOUT)) -> None:
+        super().__init__()
+        self.connections_per_host = connections_per_host
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=connections_per_host)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._held = threading.local()
+
+    @contextmanager
+    def host_slot(self, url: str) -> Iterator[None]:
+        # reentrant per thread, a caller streaming a body keeps the slot across the request it makes inside
+        host = urlsplit(url).netloc
+        held = getattr(self._held, "hosts", None)
+        if held is None:
+            held = self._held.hosts = set()
+        if host in held:
+            yield
+            return
+
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = self._host_slots[host] = threading.BoundedSemaphore(self.connections_per_host)
+        with slot:
+            held.add(host)
+            try:
+                yield
+            finally:
+                held.discard(host)
+
+    def request(self, method: str, url: str, retries: Optional[int] = None, **kwargs) -> requests.Response:
+        # retries=0 leaves retrying to the caller, e.g. a download that resumes where it stopped instead
+        retries = self.max_retries if retries is None else retries
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(retries + 1):
+            retry_after = None
+            try:
+                with self.host_slot(url):
+                    response = super().request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUS or attempt == retries:
+                    return response
+                retry_after = retry_after_seconds(response)
+                response.close()
+            except (ConnectionError, Timeout):
+                if attempt == retries:
+                    raise
+            time.sleep(backoff_delay(attempt, retry_after))
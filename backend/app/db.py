@@ -1,13 +1,130 @@
-from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
 from kheritageapi.models import PalaceDetail, PalaceImageItem, PalaceVideoItem
 from bson.objectid import ObjectId
-from pymongo import MongoClient
-from typing import Optional
-import requests
+from pymongo import MongoClient, ReplaceOne, IndexModel, ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from gridfs import GridOut
+from gridfs.errors import FileExists
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+from typing import Iterator, Optional, Union
+import threading
+import hashlib
 import gridfs
 import time
+import io
 import os
 
+from crawl_session import CrawlSession, RETRY_STATUS, backoff_delay, retry_after_seconds
+from variants import VARIANT_FORMATS, can_render, render_image, image_width, variant_widths
+
+# upper bound of bytes held in memory per streamed media response
+STREAM_BUFFER_SIZE = int(os.getenv('MEDIA_STREAM_BUFFER_SIZE', 1024 * 1024))
+# total bytes of media descriptors and small file bodies kept in memory, and the largest body worth caching
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', 64 * 1024 * 1024))
+MEDIA_CACHE_MAX_ITEM_SIZE = int(os.getenv('MEDIA_CACHE_MAX_ITEM_SIZE', 1024 * 1024))
+# bytes read from the network and written to GridFS at a time while crawling, whatever the file size
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 256 * 1024))
+
+SERVICED_LANGUAGE = ["ko", "en", "ja", "zh"]
+
+# bumped in luma.content_version after every write the API serves, API processes drop cached responses on change
+CONTENT_VERSION_ID = "content"
+# bumped in the same collection whenever the search indices change, API processes drop cached suggestions
+SEARCH_VERSION_ID = "search"
+# every query the API, the crawler and the tools run, by collection; ensure_indexes creates them
+INDEXES = {
+    "palaces": [
+        IndexModel([("palace_code", ASCENDING), ("detail_code", ASCENDING)], name="palace_code_detail_code"),
+        IndexModel([("serial_number", ASCENDING)], name="serial_number"),
+        # the search sync looks up the articles a changed detail image belongs to
+        IndexModel([("detail_image", ASCENDING)], name="detail_image"),
+        # crawled buildings have no slug until tools/add_slug.py runs, only unique among those that do
+        IndexModel([("url_slug", ASCENDING)], name="url_slug_unique", unique=True,
+                   partialFilterExpression={"url_slug": {"$type": "string"}}),
+    ],
+    "images.files": [
+        IndexModel([("url", ASCENDING)], name="url"),
+        # every url the same content was crawled from
+        IndexModel([("aliases", ASCENDING)], name="aliases"),
+        # files stored before content hashing have no sha256 and are left out
+        IndexModel([("sha256", ASCENDING)], name="sha256_unique", unique=True,
+                   partialFilterExpression={"sha256": {"$type": "string"}}),
+    ],
+    "variants.files": [
+        # the API looks for the narrowest variant in a format at least as wide as requested
+        IndexModel([("image_id", ASCENDING), ("format", ASCENDING), ("width", ASCENDING)],
+                   name="image_id_format_width"),
+    ],
+    "building_views": [
+        IndexModel([("building_id", ASCENDING), ("language", ASCENDING)], name="building_id_language", unique=True),
+        IndexModel([("url_slug", ASCENDING), ("language", ASCENDING)], name="url_slug_language"),
+        IndexModel([("language", ASCENDING), ("palace_code", ASCENDING), ("detail_code", ASCENDING)],
+                   name="language_palace_code_detail_code"),
+    ],
+}
+# indexes created by earlier versions that the ones above replace
+LEGACY_INDEXES = {
+    "palaces": ["url_slug_1"],
+}
+
+IMAGE_EXTENSIONS = ["png", "jpg", "jpeg", "gif", "webp", "svg", "bmp", "ico"]
+VIDEO_EXTENSIONS = ["mp4", "webm", "ogg"]
+
+
+def guess_media_type(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    file_extension = url.split(".")[-1]
+    if file_extension in IMAGE_EXTENSIONS:
+        return f"image/{file_extension}"
+    if file_extension in VIDEO_EXTENSIONS:
+        return f"video/{file_extension}"
+    return None
+
+
+def create_indexes(database: Database) -> None:
+    # create_indexes is a no-op for indexes that already exist with the same options
+    for collection_name, index_names in LEGACY_INDEXES.items():
+        existing = database[collection_name].index_information()
+        for index_name in index_names:
+            if index_name in existing:
+                try:
+                    database[collection_name].drop_index(index_name)
+                except OperationFailure:
+                    # another process starting at the same time dropped it first
+                    pass
+    for collection_name, indexes in INDEXES.items():
+        database[collection_name].create_indexes(indexes)
+
+
+class MediaFile:
+    # descriptor of a stored GridFS file, built from a single lookup of its files document
+    def __init__(self, root_collection: Collection, file_document: dict, content_type: Optional[str],
+                 data: Optional[bytes] = None) -> None:
+        self.root_collection = root_collection
+        self.file_document = file_document
+        self.id = file_document["_id"]
+        self.length = file_document["length"]
+        self.chunk_size = file_document["chunkSize"]
+        self.upload_date = file_document["uploadDate"]
+        self.md5 = file_document.get("md5")
+        self.url = file_document.get("url")
+        self.content_type = content_type
+        # whole body of small files, kept by the media cache
+        self.data = data
+
+    def open(self) -> Union[GridOut, io.BytesIO]:
+        # a fresh handle per caller, the GridOut reuses the files document instead of querying it again
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return GridOut(self.root_collection, file_document=self.file_document)
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        return self.open().read()
+
 
 class LumaDB:
     def __init__(self, mongo_client_param: MongoClient = None) -> None:
@@ -19,62 +136,169 @@ class LumaDB:
         self.db = self.mongo_client.luma
 
         self.palace_db = self.db.palaces
+        # one document per building and language holding the API responses ready to send
+        self.building_view_db = self.db.building_views
         self.media_meta_db = self.db.media_meta
         self.media_db = gridfs.GridFS(self.db, collection="images")
         self.thumbnail = gridfs.GridFS(self.db, collection="thumbnails")
+        # resized copies of images per width and format, see variants.py
+        self.variants = gridfs.GridFS(self.db, collection="variants")
+        self._http = None
+        self._http_lock = threading.Lock()
 
-    @staticmethod
-    def download_file(url: str, max_retries: int = 3, retry_delay: int = 5) -> Optional[bytes]:
-        server_error_strikes = 0
-        for attempt in range(max_retries):
+    @property
+    def http(self) -> CrawlSession:
+        # pooled HTTP session for downloading media, share it with the API clients of a crawl
+        # built on first use, the API, the thumbnail workers and the tools never download anything
+        with self._http_lock:
+            if self._http is None:
+                self._http = CrawlSession()
+            return self._http
+
+    def ensure_indexes(self) -> None:
+        create_indexes(self.db)
+
+    def download_file(self, url: str, **metadata) -> Optional[ObjectId]:
+        # stream url into GridFS, resuming a cut body with Range; a body already stored returns the stored copy's id
+        grid_in = self.media_db.new_file(url=url, **metadata)
+        digest = hashlib.sha256()
+        received = 0
+        validator = None
+        retry_after = None
+        # the only retry layer of a download, the session doesn't retry these requests itself
+        for attempt in range(self.http.max_retries + 1):
+            if attempt:
+                time.sleep(backoff_delay(attempt - 1, retry_after))
+            retry_after = None
+            headers = {}
+            if received:
+                headers["Range"] = f"bytes={received}-"
+                if validator:
+                    headers["If-Range"] = validator
             try:
-                response = requests.get(url)
-                response.raise_for_status()
-                return response.content
-            except HTTPError as e:
-                if 400 <= e.response.status_code < 600:
-                    server_error_strikes += 1
-                if server_error_strikes >= 3:
-                    return None
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-            except (ConnectionError, Timeout, RequestException) as e:
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    raise e
-
-        raise Exception(f"Failed to download {url}")
+                # the host slot is held while the body streams, not while backing off between attempts
+                with self.http.host_slot(url), \
+                        self.http.get(url, headers=headers, stream=True, retries=0) as response:
+                    if response.status_code in RETRY_STATUS and attempt < self.http.max_retries:
+                        retry_after = retry_after_seconds(response)
+                        continue
+                    if response.status_code >= 400 and not received:
+                        grid_in.abort()
+                        return None
+                    content_range = response.headers.get("Content-Range", "")
+                    if received and (response.status_code != 206
+                                     or not content_range.startswith(f"bytes {received}-")):
+                        # the server ignored or refused the range or the file changed meanwhile, start over
+                        # a refused range answers with an error, the next attempt repeats the full request
+                        grid_in.abort()
+                        grid_in = self.media_db.new_file(url=url, **metadata)
+                        digest = hashlib.sha256()
+                        received = 0
+                        validator = None
+                        if response.status_code >= 400:
+                            continue
+                    validator = validator or response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+                    # only a body that isn't content-encoded can be checked against Content-Length
+                    expected = None
+                    if not response.headers.get("Content-Encoding") and "Content-Length" in response.headers:
+                        expected = received + int(response.headers["Content-Length"])
+                    for chunk in response.iter_content(chunk_size=INGEST_CHUNK_SIZE):
+                        grid_in.write(chunk)
+                        digest.update(chunk)
+                        received += len(chunk)
+                if expected is None or received == expected:
+                    return self._close_content_addressed(grid_in, digest.hexdigest())
+                if received > expected:
+                    raise ValueError(f"Received {received} bytes of {url}, expected {expected}")
+            except (ConnectionError, Timeout, ChunkedEncodingError):
+                if attempt == self.http.max_retries:
+                    grid_in.abort()
+                    raise
+            except Exception as e:
+                grid_in.abort()
+                raise e
+
+        grid_in.abort()
+        raise IOError(f"Failed to download {url}, received {received} bytes")
+
+    def _close_content_addressed(self, grid_in, sha256: str) -> ObjectId:
+        existing = self.db["images.files"].find_one({"sha256": sha256}, {"_id": 1})
+        if existing:
+            grid_in.abort()
+            return existing["_id"]
+        grid_in.sha256 = sha256
+        try:
+            grid_in.close()
+        except FileExists:
+            # the same content finished downloading in another thread first, the unique index kept one copy
+            self.db["images.chunks"].delete_many({"files_id": grid_in._id})
+            return self.db["images.files"].find_one({"sha256": sha256}, {"_id": 1})["_id"]
+        return grid_in._id
 
     def save_file(self, url: str, overwrite: bool = False) -> Optional[ObjectId]:
+        # store the file once and count the reference the caller is about to write
+        if not url:
+            return None
+        files = self.db["images.files"]
         if not overwrite:
-            existing = self.media_meta_db.find_one({"url": url})
+            existing = files.find_one_and_update({"$or": [{"url": url}, {"aliases": url}]}, {"$inc": {"refs": 1}},
+                                                 projection={"_id": 1})
             if existing:
                 return existing["_id"]
-        file_content = self.download_file(url)
-        if file_content:
-            return self.media_db.put(file_content, url=url)
-        else:
+        file_id = self.download_file(url)
+        if not file_id:
             return None
 
-    def get_file(self, image_id: ObjectId):
-        # check if image_id is valid
-        if not self.media_db.exists(image_id):
-            return None
-        response = self.media_db.get(image_id)
-        file = response.read()
-        file_extension = response.url.split(".")[-1]
+        stored = files.find_one_and_update({"_id": file_id}, {"$inc": {"refs": 1}, "$addToSet": {"aliases": url}},
+                                           projection={"refs": 1}, return_document=ReturnDocument.AFTER)
+        # only the first reference to a blob builds its variants
+        if stored["refs"] == 1 and can_render(guess_media_type(url)):
+            try:
+                # images are small enough to read back, videos are never held in memory
+                self.save_variants(file_id, self.media_db.get(file_id).read())
+            except Exception as e:
+                # the API renders missing variants on demand, a broken image must not fail the crawl
+                print(f"Failed to build variants of {url}: {e}")
+        return file_id
 
-        return file, file_extension
+    def release_file(self, file_id: ObjectId) -> bool:
+        # unused until something deletes palaces or media, counts of legacy files need tools/dedupe_media.py first
+        files = self.db["images.files"]
+        stored = files.find_one_and_update({"_id": file_id}, {"$inc": {"refs": -1}}, projection={"refs": 1},
+                                           return_document=ReturnDocument.AFTER)
+        if not stored or stored["refs"] > 0:
+            return False
+        self.delete_file(file_id)
+        return True
 
-    def save_thumbnail(self, image: bytes, entry_id: ObjectId) -> None:
-        self.thumbnail.put(image, _id=entry_id)
+    def delete_file(self, file_id: ObjectId) -> None:
+        self.media_db.delete(file_id)
+        if self.thumbnail.exists(file_id):
+            self.thumbnail.delete(file_id)
+        for variant in self.db["variants.files"].find({"image_id": file_id}, {"_id": 1}):
+            self.variants.delete(variant["_id"])
 
-    def get_thumbnail(self, entry_id: ObjectId) -> Optional[bytes]:
-        if not self.thumbnail.exists(entry_id):
-            return None
-        response = self.thumbnail.get(entry_id)
-        return response.read()
+    def save_variants(self, image_id: ObjectId, data: bytes) -> int:
+        # every width of variant_widths in every format, except those the API already rendered on demand
+        original_width = image_width(data)
+        stored = {(variant["width"], variant["format"])
+                  for variant in self.db["variants.files"].find({"image_id": image_id}, {"width": 1, "format": 1})}
+        count = 0
+        for width in variant_widths(original_width):
+            for fmt in VARIANT_FORMATS:
+                if (width, fmt) not in stored:
+                    self.save_variant(image_id, width, fmt, render_image(data, width, fmt))
+                    count += 1
+        # the API serves the original to requests at least this wide
+        self.db["images.files"].update_one({"_id": image_id}, {"$set": {"width": original_width}})
+        return count
+
+    def save_variant(self, image_id: ObjectId, width: int, fmt: str, data: bytes) -> None:
+        self.variants.put(data, image_id=image_id, width=width, format=fmt, contentType=f"image/{fmt}")
+
+    def save_thumbnail(self, image: bytes, entry_id: ObjectId) -> None:
+        self.thumbnail.put(image, _id=entry_id, content_type="image/webp")
 
     def save_detailed_image(self, image: PalaceImageItem) -> ObjectId:
         saved_image = self.save_file(image.url)
@@ -95,8 +319,8 @@ class LumaDB:
         }
         return self.media_meta_db.insert_one(document).inserted_id
 
-    def get_detailed_image(self, image_id: ObjectId, language: str) -> Optional[dict]:
-        result = self.media_meta_db.find_one({"_id": image_id})
+    @staticmethod
+    def detailed_image_mongo_to_dict(result: dict, language: str) -> Optional[dict]:
         if "media" in result:
             return {
                 "name": result["name"][language],
@@ -106,6 +330,10 @@ class LumaDB:
         else:
             return None
 
+    def get_detailed_image(self, image_id: ObjectId, language: str) -> Optional[dict]:
+        result = self.media_meta_db.find_one({"_id": image_id})
+        return self.detailed_image_mongo_to_dict(result, language)
+
     def save_detailed_video(self, video: PalaceVideoItem) -> ObjectId:
         document = {
             "name": {
@@ -123,8 +351,8 @@ class LumaDB:
         }
         return self.media_meta_db.insert_one(document).inserted_id
 
-    def get_detailed_video(self, video_id: ObjectId, language: str) -> Optional[dict]:
-        result = self.media_meta_db.find_one({"_id": video_id})
+    @staticmethod
+    def detailed_video_mongo_to_dict(result: dict, language: str) -> Optional[dict]:
         if "video" in result:
             video = str(result["video"][language])
             # if video is not found, try other languages
@@ -140,6 +368,10 @@ class LumaDB:
         else:
             return None
 
+    def get_detailed_video(self, video_id: ObjectId, language: str) -> Optional[dict]:
+        result = self.media_meta_db.find_one({"_id": video_id})
+        return self.detailed_video_mongo_to_dict(result, language)
+
     def save_palace(self, palace: PalaceDetail, overwrite: bool = False) -> ObjectId:
         if not overwrite:
             existing = self.palace_db.find_one({"serial_number": palace.serial_number})
@@ -181,11 +413,53 @@ class LumaDB:
 
                 result = self.palace_db.insert_one(document).inserted_id
                 session.commit_transaction()
-                return result
             except Exception as e:
                 session.abort_transaction()
                 raise e
 
+        self.build_building_views({"_id": result})
+        self.bump_content_version()
+        return result
+
+    @staticmethod
+    def building_views(palace: dict) -> Iterator[dict]:
+        # crawled buildings get their url_slug later from tools/add_slug.py
+        palace = {**palace, "url_slug": palace.get("url_slug")}
+        for language in SERVICED_LANGUAGE:
+            yield {
+                "building_id": palace["_id"],
+                "language": language,
+                "palace_code": palace["palace_code"],
+                "detail_code": palace["detail_code"],
+                "url_slug": palace["url_slug"],
+                "building": LumaDB.building_mongo_to_dict(palace, language),
+                "preview": LumaDB.building_mongo_to_preview(palace, language),
+                "element": LumaDB.palace_element_mongo_to_dict(palace, language),
+            }
+
+    def build_building_views(self, match: Optional[dict] = None) -> int:
+        # views of the palaces matching match, a full rebuild also drops views of removed palaces
+        building_ids = []
+        writes = []
+        for palace in self.palace_db.find(match or {}):
+            building_ids.append(palace["_id"])
+            for view in self.building_views(palace):
+                writes.append(ReplaceOne({"building_id": view["building_id"], "language": view["language"]},
+                                            view, upsert=True))
+        if writes:
+            self.building_view_db.bulk_write(writes, ordered=False)
+        if match is None:
+            self.building_view_db.delete_many({"building_id": {"$nin": building_ids}})
+        return len(building_ids)
+
+    def bump_content_version(self) -> None:
+        # call after changing palaces or media_meta outside of save_palace
+        self.db.content_version.update_one({"_id": CONTENT_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+    def bump_search_version(self) -> None:
+        # call after writing to or swapping the articles indices
+        self.db.content_version.update_one({"_id": SEARCH_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
     @staticmethod
     def building_mongo_to_dict(result: dict, language: str) -> dict:
         return {
@@ -210,6 +484,14 @@ class LumaDB:
             "thumbnail": str(result["thumbnail"]),
         }
 
+    @staticmethod
+    def palace_element_mongo_to_dict(result: dict, language: str) -> dict:
+        return {
+            "name": result["name"][language],
+            "id": str(result["_id"]),
+            "url": result["url_slug"]
+        }
+
     def get_building(self, palace_id: ObjectId, language: str) -> Optional[dict]:
         result = self.palace_db.find_one({"_id": palace_id})
 
@@ -232,11 +514,7 @@ class LumaDB:
 
         return_arr = []
         for palace in result:
-            return_arr.append({
-                "name": palace["name"][language],
-                "id": str(palace["_id"]),
-                "url": palace["url_slug"]
-            })
+            return_arr.append(self.palace_element_mongo_to_dict(palace, language))
             # sort by alphabetically
         return_arr.sort(key=lambda x: x["name"])
         return return_arr
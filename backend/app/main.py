@@ -1,16 +1,29 @@
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, Response, JSONResponse
 from fastapi import FastAPI, Request, HTTPException, status
+from elasticsearch import ApiError, BadRequestError, TransportError
 from bson.objectid import ObjectId
 import bson.errors
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 import json
-
-from db import LumaDB
-from search import ElasticsearchClient
-
-db = LumaDB()
-es = ElasticsearchClient(lumaBD=db)
+import os
+
+from async_db import AsyncLumaDB
+from db import CONTENT_VERSION_ID, SEARCH_VERSION_ID
+from search import AsyncElasticsearchClient, next_cursor
+from suggest import SuggestionIndex
+from navigation import NavigationIndex
+from response_cache import ResponseCache, response_cache_backend
+from variants import can_render, variant_format
+from media import full_file_response, partial_file_response, is_not_modified, not_modified_response
+
+db = AsyncLumaDB()
+es = AsyncElasticsearchClient()
+# "elasticsearch" asks the completion suggester and falls back to the in-memory index, "memory" skips it
+autocomplete_backend = os.getenv("AUTOCOMPLETE_BACKEND", "elasticsearch")
+SEARCH_PAGE_SIZE = 30
+# building, photo and video responses only change when the crawler or a tool bumps the content version
+response_cache = ResponseCache(response_cache_backend())
 app = FastAPI(docs_url=None, redoc_url=None)
 app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
 
@@ -19,6 +32,38 @@ ui_language = {}
 for lang in serviced_language:
     with open(f"assets/lang/{lang}.json", "r", encoding="utf-8") as f:
         ui_language[lang] = json.load(f)
+suggestion_index = SuggestionIndex(serviced_language)
+navigation_index = NavigationIndex(serviced_language)
+
+db.on_version_change(CONTENT_VERSION_ID, response_cache.set_version)
+db.on_version_change(CONTENT_VERSION_ID, lambda version: navigation_index.load(db, version))
+# cached suggestions are dropped when search.py or search_sync.py bump the search version
+db.on_version_change(SEARCH_VERSION_ID, es.clear_suggestions)
+
+
+@app.on_event("startup")
+async def ensure_indexes() -> None:
+    await db.ensure_indexes()
+
+
+async def load_suggestion_index(version: int) -> None:
+    # the fallback for autocomplete follows crawls like the navigation index does
+    suggestion_index.build(await db.get_building_names())
+
+
+db.on_version_change(CONTENT_VERSION_ID, load_suggestion_index)
+
+
+@app.on_event("startup")
+async def load_versioned_state() -> None:
+    # the first check runs every callback, loading the navigation and suggestion indexes
+    await db.check_versions()
+
+
+@app.on_event("shutdown")
+async def close_clients() -> None:
+    await es.close()
+    db.mongo_client.close()
 
 
 def validate_id(object_id: str) -> Optional[ObjectId]:
@@ -45,67 +90,67 @@ def validate_palace_id(palace_id: str) -> Optional[int]:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid palace id")
 
 
+async def cached_json(resource: str, key: str, language: str,
+                      loader: Callable[[], Awaitable]) -> Optional[Response]:
+    # serialized once per content version, the same way JSONResponse would
+    async def load() -> Optional[bytes]:
+        value = await loader()
+        if not value:
+            return None
+        return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+    await db.check_versions()
+    body = await response_cache.get_or_load(resource, key, language, load)
+    if body is None:
+        return None
+    return Response(content=body, media_type="application/json")
+
+
 @app.get("/media/{media_id}")
-async def get_media(request: Request, media_id: str, thumbnail: bool = False):
+async def get_media(request: Request, media_id: str, thumbnail: bool = False, w: Optional[int] = None):
     media_id = validate_id(media_id)
+    if w is not None and w not in range(1, 4097):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid width")
 
+    headers = {}
     if thumbnail:
-        try:
-            media = db.get_thumbnail(media_id)
-        except TypeError:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Thumbnail not found")
+        media = await db.find_thumbnail(media_id)
         if not media:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Thumbnail not found")
-
-        return Response(content=media, media_type="image/webp")
-    try:
-        media, file_extension = db.get_file(media_id)
-    except TypeError:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
-    if not media:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
-
-    if file_extension in ["png", "jpg", "jpeg", "gif", "webp", "svg", "bmp", "ico"]:
-        return Response(content=media, media_type=f"image/{file_extension}")
-    elif file_extension in ["mp4", "webm", "ogg"]:
-        range_header = request.headers.get('Range')
-        if range_header:
-            return await partial_file_response(media, range_header, f"video/{file_extension}")
-        else:
-            return Response(content=media, media_type=f"video/{file_extension}")
     else:
+        media = await db.find_file(media_id)
+        if not media:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
+        if w is not None and can_render(media.content_type):
+            # the precomputed variant closest above the requested width, in the best format the client takes
+            fmt = variant_format(request.headers.get('Accept'))
+            variant = await db.find_or_render_variant(media, w, fmt)
+            if variant:
+                media = variant
+            headers['Vary'] = 'Accept'
+    if not media.content_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media format not supported")
 
-
-async def partial_file_response(data: bytes, range_header: str, media_type: str):
-    start, end = 0, None
-    file_size = len(data)
-
-    if "=" in range_header:
-        _, range_header = range_header.split("=")
-        start, end = range_header.split("-")
-        start = int(start)
-        end = int(end) if end else None
-
-    if end:
-        file_content = data[start:end + 1]
+    # answered from the file document alone, the chunks are never fetched
+    if is_not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'), media):
+        response = not_modified_response(media)
     else:
-        file_content = data[start:]
-
-    headers = {
-        'Content-Range': f'bytes {start}-{start + len(file_content) - 1}/{file_size}',
-        'Accept-Ranges': 'bytes',
-    }
-
-    return Response(content=file_content, status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type,
-                    headers=headers)
+        range_header = request.headers.get('Range')
+        if range_header:
+            response = partial_file_response(media, range_header, media.content_type,
+                                             if_range=request.headers.get('If-Range'))
+        else:
+            response = full_file_response(media, media.content_type)
+    response.headers.update(headers)
+    return response
 
 
 @app.get("/photo/")
-def get_photo(photo_id: str, language: str):
+async def get_photo(photo_id: str, language: str):
     validate_language(language)
     photo_id = validate_id(photo_id)
-    photo = db.get_detailed_image(photo_id, language)
+    photo = await cached_json("photo", str(photo_id), language,
+                              lambda: db.get_detailed_image(photo_id, language))
     if photo:
         return photo
     else:
@@ -113,10 +158,11 @@ def get_photo(photo_id: str, language: str):
 
 
 @app.get("/video/")
-def get_video(video_id: str, language: str):
+async def get_video(video_id: str, language: str):
     validate_language(language)
     video_id = validate_id(video_id)
-    video = db.get_detailed_video(video_id, language)
+    video = await cached_json("video", str(video_id), language,
+                              lambda: db.get_detailed_video(video_id, language))
     if video:
         return video
     else:
@@ -124,10 +170,11 @@ def get_video(video_id: str, language: str):
 
 
 @app.get("/building/")
-def get_palace(building_id: str, language: str):
+async def get_palace(building_id: str, language: str):
     validate_language(language)
     building_id = validate_id(building_id)
-    building = db.get_building(building_id, language)
+    building = await cached_json("building", str(building_id), language,
+                                 lambda: db.get_building(building_id, language))
     if building:
         return building
     else:
@@ -135,11 +182,12 @@ def get_palace(building_id: str, language: str):
 
 
 @app.get("/buildingurl/")
-def get_palace_url(building_name: str, language: str):
+async def get_palace_url(building_name: str, language: str):
     validate_language(language)
     if len(building_name) > 100:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="URL too long")
-    building = db.get_building_from_slug(building_name, language)
+    building = await cached_json("buildingurl", building_name, language,
+                                 lambda: db.get_building_from_slug(building_name, language))
     if building:
         return building
     else:
@@ -147,34 +195,56 @@ def get_palace_url(building_name: str, language: str):
 
 
 @app.get("/search/")
-def search(keyword: str, language: str, palace_id: str = None, cursor: int = 1):
+async def search(keyword: str, language: str, palace_id: str = None, cursor: str = None):
     validate_language(language)
     # check for malicious keyword
     if keyword.strip() == "":
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid keyword")
     if len(keyword) > 100:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search keyword too long")
+    if palace_id == "0":
+        palace_id = None
+    if palace_id:
+        palace_id = validate_palace_id(palace_id)
 
-    result = es.search_article(query=keyword, language=language, palace_id=palace_id, cursor=cursor)
+    try:
+        result = await es.search_article(query=keyword, language=language, limit=SEARCH_PAGE_SIZE,
+                                         palace_id=palace_id, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    except BadRequestError:
+        # a well formed cursor can still carry a point in time id elasticsearch can't parse
+        if not cursor:
+            raise
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
     hits = []
     for hit in result['hits']['hits']:
         hits.append({
             "id": hit['_id'],
             "title": hit['_source']['title'],
-            "text": hit['_source']['text'],
+            # html escaped, matched terms wrapped in <em>
+            "snippet": hit.get('highlight', {}).get('text', [""])[0],
         })
 
     response = {
         "hits": result['hits']['total']['value'],
-        "articles": hits
+        # false once elasticsearch stopped counting and "hits" is a lower bound
+        "hits_exact": result['hits']['total']['relation'] == "eq",
+        "articles": hits,
+        # pass back as ?cursor= for the next page, null on the last page
+        "cursor": next_cursor(result, SEARCH_PAGE_SIZE),
     }
+    # per palace counts come with the first page only
+    if 'aggregations' in result:
+        response["palaces"] = {int(bucket['key']): bucket['doc_count']
+                               for bucket in result['aggregations']['palaces']['buckets']}
 
     return response
 
 
 @app.get("/autocomplete/")
-def autocomplete(keyword: str, language: str):
+async def autocomplete(keyword: str, language: str):
     validate_language(language)
     # check for malicious keyword
     if keyword.strip() == "":
@@ -182,11 +252,15 @@ def autocomplete(keyword: str, language: str):
     if len(keyword) > 100:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search keyword too long")
 
-    result = es.autocomplete(query=keyword, language=language)
-
-    suggestions = []
-    for hit in result['suggest']['suggestion'][0]['options']:
-        suggestions.append(hit['_source']['title'])
+    await db.check_versions()
+    if autocomplete_backend == "memory":
+        suggestions = suggestion_index.suggest(keyword, language)
+    else:
+        try:
+            suggestions = await es.suggest(query=keyword, language=language)
+        except (ApiError, TransportError):
+            # elasticsearch is slow or down, the titles are in memory anyway
+            suggestions = suggestion_index.suggest(keyword, language)
 
     response = {
         "suggestions": suggestions
@@ -196,13 +270,20 @@ def autocomplete(keyword: str, language: str):
 
 
 @app.get("/random/")
-def random_article(language: str, palace_id: str = None):
+async def random_article(language: str, palace_id: str = None, count: int = None, seed: str = None, page: int = 0):
     if palace_id == "0":
         palace_id = None
     if palace_id:
-        validate_palace_id(palace_id)
+        palace_id = validate_palace_id(palace_id)
     validate_language(language)
-    article = db.get_building_random(language, palace_id)
+    if count is not None and count not in range(1, 101):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid count")
+    if page < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page")
+    if seed is not None and len(seed) > 100:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Seed too long")
+    await db.check_versions()
+    article = navigation_index.sample_previews(language, palace_id, count, seed, page)
     if article:
         return article
     else:
@@ -219,7 +300,8 @@ async def get_languages(language: str):
 async def get_palace_elements(palace_id: str, language: str):
     validate_language(language)
     palace_id = validate_palace_id(palace_id)
-    palace_elements = db.get_palace_elements(palace_id, language)
+    await db.check_versions()
+    palace_elements = navigation_index.get_palace_elements(palace_id, language)
     if palace_elements:
         return palace_elements
     else:
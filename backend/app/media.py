@@ -0,0 +1,188 @@
+from fastapi.responses import Response, StreamingResponse
+from fastapi import status
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
+import uuid
+
+from async_db import AsyncLumaDB
+from db import MediaFile
+
+# a client asking for more ranges than this is almost certainly not a video player
+MAX_RANGES = 16
+
+# stored media never change once written, a new upload always gets a new ObjectId
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def http_date(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def entity_tag(media: MediaFile) -> str:
+    # files written by older drivers carry an md5, everything else is identified by id and upload time
+    if media.md5:
+        return f'"{media.md5}"'
+    return f'"{media.id}-{int(media.upload_date.timestamp() * 1000):x}"'
+
+
+def validator_headers(media: MediaFile) -> dict:
+    return {
+        'ETag': entity_tag(media),
+        'Last-Modified': http_date(media.upload_date),
+        'Cache-Control': CACHE_CONTROL,
+    }
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], media: MediaFile) -> bool:
+    # If-None-Match takes precedence, If-Modified-Since is only consulted when it is absent
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        etag = entity_tag(media)
+        # weak comparison, W/"x" matches "x"
+        return any(tag.strip().replace("W/", "", 1) == etag for tag in if_none_match.split(","))
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have second precision, compare against what Last-Modified advertised
+        return parsedate_to_datetime(http_date(media.upload_date)) <= since
+    return False
+
+
+def not_modified_response(media: MediaFile) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validator_headers(media))
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[list]:
+    # sorted inclusive (start, end) ranges, None for a malformed header, [] when none can be satisfied
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set.strip():
+        return None
+
+    ranges = []
+    for spec in range_set.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            # suffix range, the last N bytes of the file
+            if not last:
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(file_size - length, 0), file_size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+            if last and end < start:
+                return None
+            if start >= file_size:
+                continue
+            end = min(end, file_size - 1)
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # merge overlapping and adjacent ranges so every byte is sent at most once
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range: Optional[str], media: MediaFile) -> bool:
+    # without If-Range the Range header always applies
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith("W/"):
+        # If-Range requires a strong comparison
+        return False
+    if if_range.startswith('"'):
+        return if_range == entity_tag(media)
+    try:
+        since = parsedate_to_datetime(if_range)
+    except (TypeError, ValueError):
+        return False
+    return http_date(since) == http_date(media.upload_date)
+
+
+def partial_file_response(media: MediaFile, range_header: str, media_type: str,
+                          if_range: Optional[str] = None) -> Response:
+    file_size = media.length
+    ranges = parse_range_header(range_header, file_size)
+
+    if ranges is None or not if_range_matches(if_range, media):
+        return full_file_response(media, media_type)
+
+    if not ranges:
+        headers = {
+            'Content-Range': f'bytes */{file_size}',
+            **validator_headers(media),
+        }
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers = {
+            'Content-Range': f'bytes {start}-{end}/{file_size}',
+            'Content-Length': str(end - start + 1),
+            'Accept-Ranges': 'bytes',
+            **validator_headers(media),
+        }
+        return StreamingResponse(AsyncLumaDB.iter_file(media, start, end),
+                                 status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type, headers=headers)
+
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: {media_type}\r\n'
+         f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n').encode()
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    content_length = sum(len(part) for part in part_headers) + 2 * (len(ranges) - 1) + len(closing)
+    content_length += sum(end - start + 1 for start, end in ranges)
+
+    async def iter_parts() -> AsyncIterator[bytes]:
+        for index, (start, end) in enumerate(ranges):
+            if index:
+                yield b'\r\n'
+            yield part_headers[index]
+            async for data in AsyncLumaDB.iter_file(media, start, end):
+                yield data
+        yield closing
+
+    headers = {
+        'Content-Length': str(content_length),
+        'Accept-Ranges': 'bytes',
+        **validator_headers(media),
+    }
+    return StreamingResponse(iter_parts(), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=f'multipart/byteranges; boundary={boundary}', headers=headers)
+
+
+def full_file_response(media: MediaFile, media_type: str) -> StreamingResponse:
+    headers = {
+        'Content-Length': str(media.length),
+        'Accept-Ranges': 'bytes',
+        **validator_headers(media),
+    }
+    return StreamingResponse(AsyncLumaDB.iter_file(media), media_type=media_type, headers=headers)
@@ -0,0 +1,61 @@
+from typing import Iterable, Optional
+import random
+
+from async_db import AsyncLumaDB
+
+# size of the landing page feed when the client doesn't ask for a count
+RANDOM_FEED_SIZE = 20
+
+
+class NavigationIndex:
+    # buildings per palace and language held in memory for /buildings/ and /random/, reloaded on a new content version
+    def __init__(self, serviced_language: Iterable[str]) -> None:
+        self.serviced_language = list(serviced_language)
+        self.version = None
+        # (palace_code, language) -> list
+        self.elements = {}
+        self.previews = {}
+        # language -> previews of every palace, the pool the landing page feed samples from
+        self.all_previews = {}
+
+    async def load(self, db: AsyncLumaDB, version: Optional[int] = None) -> None:
+        # an upgraded deployment has no views until they are built, read the palaces themselves meanwhile
+        from_palaces = not await db.building_views_complete()
+        elements, previews, all_previews = {}, {}, {}
+        for language in self.serviced_language:
+            for view in await db.get_sorted_elements(language, from_palaces):
+                elements.setdefault((view["palace_code"], language), []).append(view["element"])
+            all_previews[language] = []
+            for view in await db.get_ordered_previews(language, from_palaces):
+                previews.setdefault((view["palace_code"], language), []).append(view["preview"])
+                all_previews[language].append(view["preview"])
+        # swapped in whole, requests never see a half built index
+        self.elements, self.previews, self.all_previews = elements, previews, all_previews
+        self.version = version
+
+    def get_palace_elements(self, palace_id: int, language: str) -> list[dict]:
+        return self.elements.get((palace_id, language), [])
+
+    def get_palace_previews(self, palace_id: int, language: str) -> list[dict]:
+        return self.previews.get((palace_id, language), [])
+
+    def sample_previews(self, language: str, palace_id: Optional[int] = None, count: Optional[int] = None,
+                        seed: Optional[str] = None, page: int = 0) -> list[dict]:
+        # a palace lists its buildings in order, otherwise they are drawn at random; a seed makes the order repeatable
+        if palace_id:
+            pool = self.get_palace_previews(palace_id, language)
+        else:
+            pool = self.all_previews.get(language, [])
+            count = count or RANDOM_FEED_SIZE
+
+        if seed is not None:
+            order = list(range(len(pool)))
+            random.Random(seed).shuffle(order)
+        elif palace_id:
+            order = range(len(pool))
+        else:
+            return random.sample(pool, min(count, len(pool)))
+
+        if count is None:
+            return [pool[index] for index in order]
+        return [pool[index] for index in order[page * count:(page + 1) * count]]
@@ -0,0 +1,90 @@
+from typing import Awaitable, Callable, Optional
+import os
+
+from cache import LRUByteCache
+
+# "memory" keeps responses inside each API process, "redis" shares them between processes
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 32 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ITEM_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_ITEM_SIZE", 256 * 1024))
+# entries of old content versions are never read again, redis drops them after this many seconds
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 24 * 60 * 60))
+
+
+class LocalResponseBackend:
+    # stand-in for a shared cache server, used when none is configured
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_SIZE, max_item_size: int = RESPONSE_CACHE_MAX_ITEM_SIZE) -> None:
+        self.cache = LRUByteCache(max_bytes, max_item_size)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.cache.get(key)
+
+    async def put(self, key: str, value: bytes) -> None:
+        self.cache.put(key, value, len(value))
+
+    async def clear(self) -> None:
+        self.cache.clear()
+
+
+class RedisResponseBackend:
+    # a redis outage turns into cache misses, the handlers fall back to Mongo
+    def __init__(self, redis_uri: str, ttl: int = RESPONSE_CACHE_TTL) -> None:
+        # only imported when configured, redis isn't a dependency of the default setup
+        import redis.asyncio
+        import redis.exceptions
+
+        self.client = redis.asyncio.Redis.from_url(redis_uri)
+        self.errors = redis.exceptions.RedisError
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            return await self.client.get(key)
+        except self.errors:
+            return None
+
+    async def put(self, key: str, value: bytes) -> None:
+        try:
+            await self.client.set(key, value, ex=self.ttl)
+        except self.errors:
+            pass
+
+    async def clear(self) -> None:
+        # keys carry the content version, entries of an old version simply stop being asked for
+        pass
+
+
+def response_cache_backend():
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return RedisResponseBackend(os.getenv("REDIS_URI", "redis://localhost:6379/0"))
+    return LocalResponseBackend()
+
+
+class ResponseCache:
+    # serialized JSON responses per (resource, key, language), emptied by set_version on a new content version
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        self.version = None
+
+    async def set_version(self, version: int) -> None:
+        # registered with AsyncLumaDB.on_version_change
+        self.version = version
+        await self.backend.clear()
+
+    def cache_key(self, resource: str, key: str, language: str) -> str:
+        return f"luma:{self.version}:{resource}:{key}:{language}"
+
+    async def get_or_load(self, resource: str, key: str, language: str,
+                          loader: Callable[[], Awaitable[Optional[bytes]]]) -> Optional[bytes]:
+        # nothing is stored when the loader finds nothing, a later crawl may still add it
+        # taken before loading, a version bumped meanwhile must not label what was read before it
+        cache_key = self.cache_key(resource, key, language)
+        body = await self.backend.get(cache_key)
+        if body is None:
+            body = await loader()
+            if body is not None:
+                await self.backend.put(cache_key, body)
+        return body
+
+    async def clear(self) -> None:
+        await self.backend.clear()
@@ -1,10 +1,94 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch, ApiError, NotFoundError, TransportError, helpers
 from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Iterator, Optional
+import unicodedata
+import binascii
+import base64
+import json
 import re
 import os
 
+from cache import TTLCache
+from suggest import fuzzy_edits
 from db import LumaDB
 
+# search requests may take a while, autocomplete runs per keystroke and is cut short instead of queuing
+SEARCH_TIMEOUT = float(os.getenv("ELASTICSEARCH_SEARCH_TIMEOUT", 5))
+AUTOCOMPLETE_TIMEOUT = float(os.getenv("ELASTICSEARCH_AUTOCOMPLETE_TIMEOUT", 1))
+ES_CONNECTIONS_PER_NODE = int(os.getenv("ELASTICSEARCH_CONNECTIONS_PER_NODE", 50))
+# articles fetched from Mongo per round-trip and documents sent to Elasticsearch per bulk request
+BULK_BATCH_SIZE = int(os.getenv("INDEX_BULK_BATCH_SIZE", 100))
+BULK_CHUNK_SIZE = int(os.getenv("INDEX_BULK_CHUNK_SIZE", 500))
+AUTOCOMPLETE_CACHE_SIZE = int(os.getenv("AUTOCOMPLETE_CACHE_SIZE", 2048))
+AUTOCOMPLETE_CACHE_TTL = float(os.getenv("AUTOCOMPLETE_CACHE_TTL", 60))
+# palace codes run from 1 to 5
+PALACE_COUNT = 5
+# characters per search snippet, CJK scripts carry more per character than latin text
+SNIPPET_FRAGMENT_SIZE = {"ko": 80, "en": 160, "ja": 70, "zh": 60}
+# counting stops here, larger result sets report the total as a lower bound
+TRACK_TOTAL_HITS = int(os.getenv("SEARCH_TRACK_TOTAL_HITS", 1000))
+# how long a point in time stays open between two pages of the same search
+SEARCH_KEEP_ALIVE = os.getenv("ELASTICSEARCH_PIT_KEEP_ALIVE", "2m")
+# searches on a point in time sort by an implicit _shard_doc tiebreaker after o_id, o_id is unique already
+# so continuing after its largest value resumes right after the same hit on any point in time
+SHARD_DOC_MAX = 2 ** 63 - 1
+
+# suggestion lists per language keyed by normalized prefix, emptied whenever the search version changes
+suggestion_cache = {language: TTLCache(AUTOCOMPLETE_CACHE_SIZE, AUTOCOMPLETE_CACHE_TTL)
+                    for language in ["ko", "en", "ja", "zh"]}
+
+
+def encode_cursor(pit_id: Optional[str], sort_values: list) -> str:
+    payload = json.dumps({"pit": pit_id, "after": sort_values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    # returns (pit id, search_after values), raises ValueError for anything that isn't one of our cursors
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, json.JSONDecodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(payload, dict) or not isinstance(payload.get("after"), list) or len(payload["after"]) != 2:
+        raise ValueError("Invalid cursor")
+    # score and o_id, anything else would only be refused by elasticsearch
+    score, o_id = payload["after"]
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not isinstance(o_id, str):
+        raise ValueError("Invalid cursor")
+    if not isinstance(payload.get("pit"), (str, type(None))):
+        raise ValueError("Invalid cursor")
+    return payload.get("pit"), payload["after"]
+
+
+def next_cursor(result: dict, limit: int) -> Optional[str]:
+    # a short page is the last one
+    hits = result['hits']['hits']
+    if len(hits) < limit:
+        return None
+    # score and o_id, without the tiebreaker of the point in time
+    return encode_cursor(result.get('pit_id'), hits[-1]['sort'][:2])
+
+
+def normalize_prefix(query: str, language: str) -> str:
+    prefix = " ".join(unicodedata.normalize("NFKC", query).split())
+    # only the english analyzer lowercases, the CJK analyzers keep latin text as typed
+    return prefix.lower() if language == "en" else prefix
+
+
+def known_empty(prefix: str, language: str) -> bool:
+    # a shorter prefix with the same edit budget cached without suggestions means a longer one has none either
+    if language != "en":
+        return False
+    edits = fuzzy_edits(prefix)
+    for length in range(len(prefix) - 1, 0, -1):
+        shorter = prefix[:length]
+        if fuzzy_edits(shorter) != edits:
+            break
+        if suggestion_cache[language].get(shorter) == []:
+            return True
+    return False
+
 
 class ElasticsearchClient:
     def __init__(self, es_client_param: Elasticsearch = None,
@@ -20,12 +104,10 @@ class ElasticsearchClient:
         self.mongo_client = lumaBD
         self.es.ping()
 
-    def setup_index(self) -> None:
-        # reset the index
-        for language in self.serviced_language:
-            index_name = f'articles_{language}'
-            if self.es.indices.exists(index=index_name):
-                self.es.indices.delete(index=index_name)
+    def setup_index(self) -> dict:
+        # fresh timestamped index per language, the live aliases keep pointing at the old ones until swap_aliases
+        version = datetime.now().strftime("%Y%m%d%H%M%S")
+        index_names = {language: f'articles_{language}_{version}' for language in self.serviced_language}
 
         # Define the analyzer name based on the language
         analyzer_mapping = {
@@ -88,6 +170,13 @@ class ElasticsearchClient:
                 },
                 "mappings": {
                     "properties": {
+                        # exact-match only, term filters on it are cached by elasticsearch
+                        "palace_code": {
+                            "type": "keyword"
+                        },
+                        "o_id": {
+                            "type": "keyword"
+                        },
                         "title": {
                             "type": "text",
                             "analyzer": analyzer_name
@@ -107,14 +196,14 @@ class ElasticsearchClient:
                     }
                 }
             }
-            index_name = f'articles_{language}'
-            self.es.indices.create(index=index_name, body=settings)
+            self.es.indices.create(index=index_names[language], body=settings)
 
-    def index(self, title: str, body: str, palace_id: int, language: str, mongo_id) -> None:
-        # Prepare the entry for Elasticsearch
+        return index_names
 
-        es_entry = {
-            "tag": palace_id,
+    @staticmethod
+    def es_entry(title: str, body: str, palace_code: int, mongo_id) -> dict:
+        return {
+            "palace_code": str(palace_code),
             "o_id": str(mongo_id),
             "title": title,
             "text": body,
@@ -123,43 +212,117 @@ class ElasticsearchClient:
                 "weight": 10
             },
         }
-        index_name = f'articles_{language}'
-        # Insert the article into Elasticsearch
-        self.es.index(index=index_name, body=es_entry, id=mongo_id)
 
-    def index_article(self, article_id: ObjectId) -> None:
-        # get the document from MongoDB
-        document = self.mongo_client.palace_db.find_one({"_id": article_id})
-        palace_code = document["serial_number"]
-        if not document:
-            return
+    @staticmethod
+    def article_pipeline(match: dict = None) -> list:
+        # join every detail image's metadata in the same query instead of one find_one per image and language
+        pipeline = [{"$match": match}] if match else []
+        pipeline.append({
+            "$lookup": {
+                "from": "media_meta",
+                "localField": "detail_image",
+                "foreignField": "_id",
+                "as": "detail_image_meta",
+            }
+        })
+        return pipeline
+
+    def article_documents(self, article: dict) -> Iterator[tuple]:
+        # yield (language, es entry) for every serviced language of an article joined by article_pipeline
+        palace_code = article["palace_code"]
+        image_details = {image["_id"]: image for image in article["detail_image_meta"]}
 
         for language in self.serviced_language:
-            index_title = document["name"][language]
-            index_body = document["explanation"][language]
+            index_title = article["name"][language]
+            index_body = article["explanation"][language]
 
-            for image in document["detail_image"]:
-                image_detail = self.mongo_client.media_meta_db.find_one({"_id": image})
+            # $lookup doesn't keep the order of detail_image, follow the article's own order
+            for image in article["detail_image"]:
+                image_detail = image_details.get(image)
                 # check  image_detail["name"][language] is not None
-                if image_detail["name"][language] and image_detail["explanation"][language]:
+                if image_detail and image_detail["name"][language] and image_detail["explanation"][language]:
                     index_body += "\n" + image_detail["name"][language] + "\n" + image_detail["explanation"][language]
             # Using Ragex to remove HTML tags
             index_body = re.sub('<[^>]*>', '', index_body, 0).strip()
-            # index the article
-            self.index(index_title, index_body, palace_code, language, article_id)
+            yield language, self.es_entry(index_title, index_body, palace_code, article["_id"])
 
-    def index_all_articles(self) -> None:
-        # get all articles from MongoDB
-        articles = self.mongo_client.palace_db.find(limit=0)
-        article_count = self.mongo_client.palace_db.count_documents({})
+    def index_article(self, article_id: ObjectId) -> None:
+        # get the document from MongoDB
+        for article in self.mongo_client.palace_db.aggregate(self.article_pipeline({"_id": article_id})):
+            for language, es_entry in self.article_documents(article):
+                self.es.index(index=f'articles_{language}', body=es_entry, id=str(article_id))
+        self.mongo_client.bump_search_version()
 
-        for i, article in enumerate(articles):
-            print(f"Indexing article {i + 1} of {article_count}")
-            self.index_article(article["_id"])
+    def delete_article(self, article_id: ObjectId) -> None:
+        for language in self.serviced_language:
+            self.es.options(ignore_status=404).delete(index=f'articles_{language}', id=str(article_id))
+        self.mongo_client.bump_search_version()
 
-    def search_article(self, query: str, language: str, limit: int = 30, cursor: int = 1,
-                       palace_id: int = None) -> dict:
-        index_name = f'articles_{language}'
+    def index_all_articles(self, index_names: Optional[dict] = None) -> None:
+        # defaults to the live aliases, reindex() passes the new versioned indices instead
+        if index_names is None:
+            index_names = {language: f'articles_{language}' for language in self.serviced_language}
+        index_list = list(index_names.values())
+        # refreshing while loading only produces segments that get merged away again
+        self.es.indices.put_settings(index=index_list, settings={"index": {"refresh_interval": "-1"}})
+        try:
+            articles = self.mongo_client.palace_db.aggregate(self.article_pipeline(), batchSize=BULK_BATCH_SIZE)
+            actions = (
+                {"_index": index_names[language], "_id": str(article["_id"]), "_source": es_entry}
+                for article in articles
+                for language, es_entry in self.article_documents(article)
+            )
+            indexed, errors = helpers.bulk(self.es, actions, chunk_size=BULK_CHUNK_SIZE, raise_on_error=False)
+        finally:
+            self.es.indices.put_settings(index=index_list, settings={"index": {"refresh_interval": None}})
+            self.es.indices.refresh(index=index_list)
+
+        self.mongo_client.bump_search_version()
+        print(f"Indexed {indexed} documents, {len(errors)} failed")
+        for error in errors:
+            print(error)
+
+    def warm_up(self, index_names: dict) -> None:
+        # merge the freshly loaded segments and run one search and suggestion per index before it goes live
+        index_list = list(index_names.values())
+        self.es.indices.forcemerge(index=index_list, max_num_segments=1)
+        for index_name in index_list:
+            self.es.search(index=index_name, body=self.search_body("palace", limit=1))
+            self.es.search(index=index_name, body=self.autocomplete_body("p"))
+
+    def swap_aliases(self, index_names: dict) -> None:
+        # one atomic alias switch, then the indices the aliases used to point at are dropped
+        actions = []
+        previous_indices = []
+        for language, index_name in index_names.items():
+            alias = f'articles_{language}'
+            if self.es.indices.exists_alias(name=alias):
+                for name in self.es.indices.get_alias(name=alias):
+                    previous_indices.append(name)
+                    actions.append({"remove": {"index": name, "alias": alias}})
+            elif self.es.indices.exists(index=alias):
+                actions.append({"remove_index": {"index": alias}})
+            actions.append({"add": {"index": index_name, "alias": alias}})
+
+        self.es.indices.update_aliases(actions=actions)
+        self.mongo_client.bump_search_version()
+        if previous_indices:
+            self.es.indices.delete(index=previous_indices)
+
+    def reindex(self) -> None:
+        # build next to the live indices and switch over atomically, searches never see a missing index
+        index_names = self.setup_index()
+        try:
+            self.index_all_articles(index_names)
+            self.warm_up(index_names)
+        except Exception as e:
+            self.es.indices.delete(index=list(index_names.values()))
+            raise e
+        self.swap_aliases(index_names)
+
+    @staticmethod
+    def search_body(query: str, limit: int = 30, search_after: Optional[list] = None, palace_id: int = None,
+                    pit_id: Optional[str] = None, language: str = "en") -> dict:
         body = {
             "query": {
                 "bool": {
@@ -171,20 +334,52 @@ class ElasticsearchClient:
                     }
                 }
             },
+            # o_id breaks ties between equal scores so every hit has a unique position to continue after
             "sort": [
                 {"_score": {"order": "desc"}},
-            ]
+                {"o_id": {"order": "asc"}},
+            ],
+            "size": limit,
+            "track_total_hits": TRACK_TOTAL_HITS,
+            # the full text is only needed for the snippet, which elasticsearch cuts out itself
+            "_source": ["title"],
+            "highlight": {
+                "encoder": "html",
+                "fields": {
+                    "text": {
+                        "fragment_size": SNIPPET_FRAGMENT_SIZE[language],
+                        "number_of_fragments": 1,
+                        # articles matching on the title alone still get the start of their text
+                        "no_match_size": SNIPPET_FRAGMENT_SIZE[language],
+                    }
+                }
+            },
         }
-        if cursor > 1:
-            body["from"] = (cursor - 1) * limit
+        if search_after:
+            body["search_after"] = search_after
+        else:
+            # hit counts per palace for the whole result set, the palace filter below doesn't narrow them
+            # only the first page asks for them, they don't change while scrolling
+            body["aggs"] = {
+                "palaces": {
+                    "terms": {"field": "palace_code", "size": PALACE_COUNT}
+                }
+            }
+        if pit_id:
+            body["pit"] = {"id": pit_id, "keep_alive": SEARCH_KEEP_ALIVE}
         if palace_id:
-            body["query"]["bool"]["filter"] = {"term": {"palace_id": palace_id}}
+            palace_filter = {"term": {"palace_code": str(palace_id)}}
+            if "aggs" in body:
+                # post_filter runs after the aggregations, so they still count every palace
+                body["post_filter"] = palace_filter
+            else:
+                # without aggregations other palaces don't need to be matched and scored at all
+                body["query"]["bool"]["filter"] = palace_filter
+        return body
 
-        return self.es.search(index=index_name, body=body, size=limit)
-
-    def autocomplete(self, query: str, language: str) -> dict:
-        index_name = f'articles_{language}'
-        return self.es.search(index=index_name, body={
+    @staticmethod
+    def autocomplete_body(query: str) -> dict:
+        return {
             "suggest": {
                 "suggestion": {
                     "prefix": query,
@@ -196,13 +391,105 @@ class ElasticsearchClient:
                     }
                 }
             }
-        })
+        }
+
+    def search_article(self, query: str, language: str, limit: int = 30, cursor: Optional[str] = None,
+                       palace_id: int = None) -> dict:
+        # without a point in time, pages continue on the live index
+        index_name = f'articles_{language}'
+        search_after = decode_cursor(cursor)[1] if cursor else None
+        body = self.search_body(query, limit, search_after, palace_id, language=language)
+        return self.es.search(index=index_name, body=body)
+
+    def autocomplete(self, query: str, language: str) -> dict:
+        index_name = f'articles_{language}'
+        return self.es.search(index=index_name, body=self.autocomplete_body(query))
+
+
+class AsyncElasticsearchClient:
+    # query side for the API, searches and autocompletes share one pooled async connection pool
+    def __init__(self, es_client_param: AsyncElasticsearch = None) -> None:
+        if not es_client_param:
+            es_uri = os.getenv("ELASTICSEARCH_URI", "http://localhost:9200")
+            es_client = AsyncElasticsearch(hosts=[es_uri], connections_per_node=ES_CONNECTIONS_PER_NODE,
+                                           request_timeout=SEARCH_TIMEOUT, max_retries=1, retry_on_timeout=False)
+        else:
+            es_client = es_client_param
+
+        self.serviced_language = ["ko", "en", "ja", "zh"]
+        self.es = es_client
+
+    async def clear_suggestions(self, version: Optional[int] = None) -> None:
+        # registered with AsyncLumaDB.on_version_change for the search version the indexing process bumps
+        for cache in suggestion_cache.values():
+            cache.clear()
+
+    async def open_point_in_time(self, language: str) -> str:
+        result = await self.es.options(request_timeout=SEARCH_TIMEOUT).open_point_in_time(
+            index=f'articles_{language}', keep_alive=SEARCH_KEEP_ALIVE)
+        return result['id']
+
+    async def close_point_in_time(self, pit_id: str) -> None:
+        try:
+            await self.es.options(request_timeout=SEARCH_TIMEOUT, ignore_status=404).close_point_in_time(id=pit_id)
+        except (ApiError, TransportError):
+            # the point in time expires after SEARCH_KEEP_ALIVE anyway, the page was already found
+            pass
+
+    async def search_article(self, query: str, language: str, limit: int = 30, cursor: Optional[str] = None,
+                             palace_id: int = None) -> dict:
+        # the first page opens a point in time only when there is a next page, raises ValueError for a bad cursor
+        if not cursor:
+            body = ElasticsearchClient.search_body(query, limit, None, palace_id, language=language)
+            result = await self.es.options(request_timeout=SEARCH_TIMEOUT).search(index=f'articles_{language}',
+                                                                                 body=body)
+            if len(result['hits']['hits']) >= limit:
+                result['pit_id'] = await self.open_point_in_time(language)
+            return result
+
+        pit_id, search_after = decode_cursor(cursor)
+        if not pit_id:
+            pit_id = await self.open_point_in_time(language)
+        body = ElasticsearchClient.search_body(query, limit, search_after + [SHARD_DOC_MAX], palace_id, pit_id,
+                                               language)
+        try:
+            # the index comes from the point in time and must not be repeated
+            result = await self.es.options(request_timeout=SEARCH_TIMEOUT).search(body=body)
+        except NotFoundError:
+            # the point in time expired between two pages, carry on from the same position on a fresh one
+            body["pit"]["id"] = await self.open_point_in_time(language)
+            result = await self.es.options(request_timeout=SEARCH_TIMEOUT).search(body=body)
+        if len(result['hits']['hits']) < limit:
+            await self.close_point_in_time(result.get('pit_id', body["pit"]["id"]))
+        return result
+
+    async def autocomplete(self, query: str, language: str) -> dict:
+        index_name = f'articles_{language}'
+        body = ElasticsearchClient.autocomplete_body(query)
+        return await self.es.options(request_timeout=AUTOCOMPLETE_TIMEOUT).search(index=index_name, body=body)
+
+    async def suggest(self, query: str, language: str) -> list[str]:
+        prefix = normalize_prefix(query, language)
+        cache = suggestion_cache[language]
+        suggestions = cache.get(prefix)
+        if suggestions is not None:
+            return suggestions
+
+        if known_empty(prefix, language):
+            suggestions = []
+        else:
+            result = await self.autocomplete(query=prefix, language=language)
+            suggestions = [hit['_source']['title'] for hit in result['suggest']['suggestion'][0]['options']]
+        cache.put(prefix, suggestions)
+        return suggestions
+
+    async def close(self) -> None:
+        await self.es.close()
 
 
 if __name__ == "__main__":
     es = ElasticsearchClient()
-    es.setup_index()
-    es.index_all_articles()
+    es.reindex()
 
     # testing_lang = "en"
     # testing_query = input("Search for: ")
@@ -0,0 +1,101 @@
+from pymongo.errors import OperationFailure, PyMongoError
+from elasticsearch import ApiError, TransportError
+from datetime import datetime
+from typing import Optional
+import time
+
+from db import LumaDB
+from search import ElasticsearchClient
+
+WATCHED_COLLECTIONS = ["palaces", "media_meta"]
+# the server no longer has the oplog entries the stored resume token points at
+CHANGE_STREAM_HISTORY_LOST = 286
+RETRY_DELAY = 5
+# changes folded into one round of re-indexing before the resume token is saved
+MAX_BATCH = 500
+# seconds between two saves of the resume token while nothing changes, every save is itself an oplog entry
+IDLE_SAVE_INTERVAL = 60
+
+
+class SearchIndexSync:
+    # re-indexes the articles a change on palaces or media_meta touches, needs a replica set
+    def __init__(self, db: LumaDB, es: ElasticsearchClient) -> None:
+        self.db = db
+        self.es = es
+        self.state_db = db.db.search_sync
+
+    def load_resume_token(self) -> Optional[dict]:
+        state = self.state_db.find_one({"_id": "change_stream"})
+        return state["resume_token"] if state else None
+
+    def save_resume_token(self, token: dict) -> None:
+        self.state_db.update_one({"_id": "change_stream"},
+                                 {"$set": {"resume_token": token, "updated": datetime.utcnow()}}, upsert=True)
+
+    def affected_articles(self, change: dict) -> tuple:
+        # returns the ids to re-index and the ids to remove from the index for one change event
+        collection = change["ns"]["coll"]
+        document_id = change["documentKey"]["_id"]
+
+        if collection == "palaces":
+            if change["operationType"] == "delete":
+                return set(), {document_id}
+            return {document_id}, set()
+
+        # detail images are folded into the text of every article that lists them
+        articles = self.db.palace_db.find({"detail_image": document_id}, {"_id": 1})
+        return {article["_id"] for article in articles}, set()
+
+    def apply(self, to_index: set, to_delete: set) -> None:
+        for article_id in to_delete:
+            self.es.delete_article(article_id)
+        for article_id in to_index - to_delete:
+            self.es.index_article(article_id)
+        if to_index or to_delete:
+            print(f"Synced {len(to_index - to_delete)} articles, removed {len(to_delete)}")
+
+    def run(self) -> None:
+        pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+        while True:
+            try:
+                with self.db.db.watch(pipeline, resume_after=self.load_resume_token()) as stream:
+                    print("Watching for changes")
+                    next_idle_save = time.monotonic() + IDLE_SAVE_INTERVAL
+                    while stream.alive:
+                        to_index, to_delete = set(), set()
+                        # drain everything already queued so a burst of edits re-indexes each article once
+                        # try_next waits up to the server's await time when nothing is queued
+                        change = stream.try_next()
+                        changes = 0
+                        while change is not None:
+                            if change["operationType"] in ("insert", "update", "replace", "delete"):
+                                index_ids, delete_ids = self.affected_articles(change)
+                                to_index |= index_ids
+                                to_delete |= delete_ids
+                            changes += 1
+                            if changes >= MAX_BATCH:
+                                break
+                            change = stream.try_next()
+
+                        self.apply(to_index, to_delete)
+                        # an idle stream still advances its post batch token, keep it from falling off the oplog
+                        idle_save_due = time.monotonic() >= next_idle_save
+                        if stream.resume_token and (changes or idle_save_due):
+                            self.save_resume_token(stream.resume_token)
+                            next_idle_save = time.monotonic() + IDLE_SAVE_INTERVAL
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAM_HISTORY_LOST:
+                    raise e
+                # events were missed for good, rebuild everything and start over from now
+                print("Resume token expired, rebuilding the search indices")
+                self.state_db.delete_one({"_id": "change_stream"})
+                self.es.reindex()
+            except (PyMongoError, ApiError, TransportError) as e:
+                # the unsaved batch is replayed from the last stored resume token
+                print(f"Search sync interrupted: {e}")
+                time.sleep(RETRY_DELAY)
+
+
+if __name__ == "__main__":
+    luma_db = LumaDB()
+    SearchIndexSync(luma_db, ElasticsearchClient(lumaBD=luma_db)).run()
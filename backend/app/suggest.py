@@ -0,0 +1,144 @@
+from typing import Iterable
+import unicodedata
+import bisect
+
+CHOSEONG = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+JUNGSEONG = "ㅏㅐㅑㅒㅓㅔㅕㅖㅗㅘㅙㅚㅛㅜㅝㅞㅟㅠㅡㅢㅣ"
+JONGSEONG = ["", "ㄱ", "ㄲ", "ㄳ", "ㄴ", "ㄵ", "ㄶ", "ㄷ", "ㄹ", "ㄺ", "ㄻ", "ㄼ", "ㄽ", "ㄾ", "ㄿ", "ㅀ", "ㅁ",
+             "ㅂ", "ㅄ", "ㅅ", "ㅆ", "ㅇ", "ㅈ", "ㅊ", "ㅋ", "ㅌ", "ㅍ", "ㅎ"]
+# compound vowels and final clusters are split so a syllable still being composed in the IME is a prefix
+COMPOUND_JAMO = {
+    "ㅘ": "ㅗㅏ", "ㅙ": "ㅗㅐ", "ㅚ": "ㅗㅣ", "ㅝ": "ㅜㅓ", "ㅞ": "ㅜㅔ", "ㅟ": "ㅜㅣ", "ㅢ": "ㅡㅣ",
+    "ㄳ": "ㄱㅅ", "ㄵ": "ㄴㅈ", "ㄶ": "ㄴㅎ", "ㄺ": "ㄹㄱ", "ㄻ": "ㄹㅁ", "ㄼ": "ㄹㅂ", "ㄽ": "ㄹㅅ",
+    "ㄾ": "ㄹㅌ", "ㄿ": "ㄹㅍ", "ㅀ": "ㄹㅎ", "ㅄ": "ㅂㅅ",
+}
+
+HANGUL_BASE = 0xAC00
+HANGUL_LAST = 0xD7A3
+KATAKANA_FIRST = 0x30A1
+KATAKANA_LAST = 0x30F6
+KANA_OFFSET = 0x60
+
+# the elasticsearch completion suggester returns five options unless told otherwise
+SUGGESTION_SIZE = 5
+
+
+def compatibility_jamo_table() -> dict:
+    # NFKC turns typed compatibility jamo (ㅎ) into conjoining jamo (U+1112), map those back by name
+    table = {}
+    for code in range(0x1100, 0x1200):
+        name = unicodedata.name(chr(code), "")
+        for kind in ("CHOSEONG ", "JUNGSEONG ", "JONGSEONG "):
+            if kind in name:
+                try:
+                    table[code] = unicodedata.lookup(name.replace(kind, "LETTER "))
+                except KeyError:
+                    pass
+    return table
+
+
+CONJOINING_TO_COMPATIBILITY = compatibility_jamo_table()
+
+
+def decompose_hangul(text: str) -> str:
+    result = []
+    for char in text:
+        code = ord(char)
+        if HANGUL_BASE <= code <= HANGUL_LAST:
+            index = code - HANGUL_BASE
+            jamo = CHOSEONG[index // 588] + JUNGSEONG[(index % 588) // 28] + JONGSEONG[index % 28]
+        else:
+            jamo = char
+        result.append("".join(COMPOUND_JAMO.get(part, part) for part in jamo))
+    return "".join(result)
+
+
+def katakana_to_hiragana(text: str) -> str:
+    return "".join(chr(ord(char) - KANA_OFFSET) if KATAKANA_FIRST <= ord(char) <= KATAKANA_LAST else char
+                   for char in text)
+
+
+def normalize(text: str, language: str) -> str:
+    # NFKC folds half width kana and full width latin, whitespace is collapsed like the analyzers do
+    text = " ".join(unicodedata.normalize("NFKC", text).split()).lower()
+    if language == "ko":
+        return decompose_hangul(text.translate(CONJOINING_TO_COMPATIBILITY))
+    if language == "ja":
+        return katakana_to_hiragana(text)
+    return text
+
+
+def fuzzy_edits(prefix: str) -> int:
+    # edit distance "fuzziness": "auto" allows for a prefix of this length
+    if len(prefix) < 3:
+        return 0
+    return 1 if len(prefix) < 6 else 2
+
+
+def prefix_distance(query: str, candidate: str, max_edits: int) -> int:
+    # smallest edit distance between query and any prefix of candidate, max_edits + 1 once it is exceeded
+    previous = list(range(len(candidate) + 1))
+    for i, query_char in enumerate(query, 1):
+        current = [i] + [0] * len(candidate)
+        for j, candidate_char in enumerate(candidate, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (query_char != candidate_char))
+        if min(current) > max_edits:
+            return max_edits + 1
+        previous = current
+    return min(previous)
+
+
+class SuggestionIndex:
+    # in-memory prefix index over the building titles, sorted normalized keys looked up with bisect
+    def __init__(self, serviced_language: Iterable[str]) -> None:
+        self.serviced_language = list(serviced_language)
+        self.keys = {language: [] for language in self.serviced_language}
+        self.titles = {language: [] for language in self.serviced_language}
+
+    def build(self, buildings: Iterable[dict]) -> None:
+        entries = {language: set() for language in self.serviced_language}
+        for building in buildings:
+            for language in self.serviced_language:
+                title = building["name"].get(language)
+                if title:
+                    entries[language].add((normalize(title, language), title))
+
+        for language in self.serviced_language:
+            ordered = sorted(entries[language])
+            self.keys[language] = [key for key, _ in ordered]
+            self.titles[language] = [title for _, title in ordered]
+
+    def suggest(self, query: str, language: str, size: int = SUGGESTION_SIZE) -> list[str]:
+        keys, titles = self.keys[language], self.titles[language]
+        prefix = normalize(query, language)
+        if not prefix:
+            return []
+
+        # exact prefix matches are one contiguous run of the sorted keys
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + "\uffff", lo=start)
+        suggestions = titles[start:min(end, start + size)]
+
+        # the completion suggester's budget, counted on the typed characters rather than on jamo
+        max_edits = fuzzy_edits(" ".join(query.split()))
+        if len(suggestions) >= size or max_edits == 0:
+            return suggestions
+
+        # the first character has to match, which narrows the scan to another contiguous run
+        first_start = bisect.bisect_left(keys, prefix[0])
+        first_end = bisect.bisect_left(keys, prefix[0] + "\uffff", lo=first_start)
+        # jamo spell one typed syllable with up to five characters, scale the budget accordingly
+        if language == "ko":
+            max_edits *= 2
+        fuzzy = []
+        for index in range(first_start, first_end):
+            if start <= index < end:
+                continue
+            distance = prefix_distance(prefix, keys[index], max_edits)
+            if distance <= max_edits:
+                fuzzy.append((distance, keys[index], titles[index]))
+        fuzzy.sort()
+
+        suggestions.extend(title for _, _, title in fuzzy[:size - len(suggestions)])
+        return suggestions
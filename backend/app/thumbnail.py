@@ -1,61 +1,148 @@
-import io
+from concurrent.futures import ProcessPoolExecutor
+from bson.objectid import ObjectId
+from typing import Optional
+import argparse
+import json
 import csv
-from PIL import Image
-from db import LumaDB
+import os
 
-# Initialize database
-db = LumaDB()
-images_db = db.db.images.files
+from db import LumaDB, guess_media_type
+from variants import VARIANT_FORMATS, render_image, can_render, variant_widths
 
+THUMBNAIL_WIDTH = 480
+THUMBNAIL_QUALITY = 80
+# formats Pillow can't rasterize, never worth a worker's time
+SKIPPED_EXTENSIONS = ["svg"]
+CHECKPOINT_FILE = "thumbnail_checkpoint.json"
+REPORT_FILE = "failed_image_processing.csv"
+VARIANT_CHECKPOINT_FILE = "variant_checkpoint.json"
+VARIANT_REPORT_FILE = "failed_variant_processing.csv"
+# completed images between two checkpoint writes
+CHECKPOINT_INTERVAL = 100
 
-def process_image(image_meta):
-    db = LumaDB()  # Create a new instance for each process
-    try:
-        file_result = db.get_file(image_id)
+# one connection per worker process, created by the pool initializer
+worker_db = None
 
-        if file_result and isinstance(file_result, tuple):
-            file_data, file_extension = file_result
 
-            if file_data and file_extension.lower() in ["png", "jpg", "jpeg", "gif", "webp", "svg", "bmp", "ico"]:
-                image = Image.open(io.BytesIO(file_data))
+def init_worker() -> None:
+    global worker_db
+    worker_db = LumaDB()
 
-                # Resize the image
-                aspect_ratio = image.height / image.width
-                new_height = int(480 * aspect_ratio)
-                resized_image = image.resize((480, new_height))
 
-                # Convert to WebP
-                img_byte_arr = io.BytesIO()
-                resized_image.save(img_byte_arr, format='WebP', quality=80)
-                img_byte_arr = img_byte_arr.getvalue()
+def read_image(image_id: ObjectId) -> bytes:
+    # straight from GridFS, a worker reads every image once and the media cache would only hold memory
+    return worker_db.media_db.get(image_id).read()
 
-                # Save the thumbnail
-                db.save_thumbnail(img_byte_arr, image_id)
 
-            else:
-                raise ValueError("Invalid file data or unsupported file extension")
-        else:
-            raise ValueError("File not found or returned data is not valid")
-        return True
-    except Exception as e:
-        return image_id, str(e)
+def render_thumbnail(data: bytes) -> bytes:
+    return render_image(data, THUMBNAIL_WIDTH, "webp", THUMBNAIL_QUALITY)
 
 
-def save_failed_processes(failed_processes):
-    with open('failed_image_processing.csv', mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['image_id', 'error'])
-        for failed in failed_processes:
-            writer.writerow(failed)
+def make_thumbnail(image_id: ObjectId) -> tuple:
+    # runs in a worker, returns (image_id, error message or None)
+    try:
+        worker_db.save_thumbnail(render_thumbnail(read_image(image_id)), image_id)
+        return image_id, None
+    except Exception as e:
+        return image_id, f"{type(e).__name__}: {e}"
 
 
-for image in images_db.find():
-    image_id = image["_id"]
-    # convert all images to JPEG
+def make_variants(image_id: ObjectId) -> tuple:
+    # images crawled before variants existed, new ones get theirs in LumaDB.save_file
     try:
-        process_image(image_id)
-        print(f"Processed image {image_id}")
+        worker_db.save_variants(image_id, read_image(image_id))
+        return image_id, None
     except Exception as e:
-        print(f"Failed to process image {image_id}: {e}")
-        save_failed_processes([(image_id, e)])
+        return image_id, f"{type(e).__name__}: {e}"
+
+
+def load_checkpoint(path: str) -> dict:
+    # image id -> error of every image that failed in an earlier run
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)["failed"]
+
+
+def save_checkpoint(path: str, failed: dict) -> None:
+    # written next to the final file and renamed, an interrupted write never loses the previous checkpoint
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"failed": failed}, file)
+    os.replace(path + ".tmp", path)
+
+
+def save_failed_processes(path: str, failed: dict) -> None:
+    with open(path, mode="w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["image_id", "error"])
+        for image_id, error in failed.items():
+            writer.writerow([image_id, error])
+
+
+def stored_variants(db: LumaDB) -> dict:
+    # image id -> {(width, format)} of its variants, including those the API rendered on demand
+    stored = {}
+    for variant in db.db["variants.files"].find({}, {"image_id": 1, "width": 1, "format": 1}):
+        stored.setdefault(variant["image_id"], set()).add((variant["width"], variant["format"]))
+    return stored
+
+
+def pending_images(db: LumaDB, failed: dict, retry_failed: bool, variants: bool = False) -> list:
+    # done means a thumbnail, or every variant width and format; images without a recorded width are pending
+    if variants:
+        stored = stored_variants(db)
+    else:
+        done = set(db.db["thumbnails.files"].distinct("_id"))
+    pending = []
+    for image in db.db["images.files"].find({}, {"url": 1, "contentType": 1, "width": 1}):
+        media_type = image.get("contentType") or guess_media_type(image.get("url")) or ""
+        if not media_type.startswith("image/") or media_type.split("/")[-1] in SKIPPED_EXTENSIONS:
+            continue
+        if variants and not can_render(media_type):
+            continue
+        if variants:
+            expected = {(width, fmt) for width in variant_widths(image["width"]) for fmt in VARIANT_FORMATS} \
+                if "width" in image else None
+            is_done = expected is not None and expected <= stored.get(image["_id"], set())
+        else:
+            is_done = image["_id"] in done
+        if is_done or (str(image["_id"]) in failed and not retry_failed):
+            continue
+        pending.append(image["_id"])
+    return pending
+
+
+def build_thumbnails(workers: Optional[int] = None, retry_failed: bool = False, variants: bool = False) -> None:
+    # safe to interrupt, a new run skips done images and, unless retry_failed, the failed ones
+    checkpoint_path = VARIANT_CHECKPOINT_FILE if variants else CHECKPOINT_FILE
+    report_path = VARIANT_REPORT_FILE if variants else REPORT_FILE
+    failed = load_checkpoint(checkpoint_path)
+    if retry_failed:
+        failed = {}
+    pending = pending_images(LumaDB(), failed, retry_failed, variants)
+    print(f"{len(pending)} images to process")
+
+    completed = 0
+    job = make_variants if variants else make_thumbnail
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        for image_id, error in executor.map(job, pending, chunksize=8):
+            completed += 1
+            if error:
+                failed[str(image_id)] = error
+                print(f"Failed to process image {image_id}: {error}")
+            if completed % CHECKPOINT_INTERVAL == 0:
+                save_checkpoint(checkpoint_path, failed)
+                print(f"Processed {completed}/{len(pending)} images")
+
+    save_checkpoint(checkpoint_path, failed)
+    save_failed_processes(report_path, failed)
+    print(f"Processed {completed} images, {len(failed)} failed, see {report_path}")
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the WebP thumbnails or responsive variants of stored images")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--retry-failed", action="store_true", help="try images that failed in earlier runs again")
+    parser.add_argument("--variants", action="store_true", help="build the responsive variants instead")
+    args = parser.parse_args()
+    build_thumbnails(args.workers, args.retry_failed, args.variants)
@@ -0,0 +1,64 @@
+from typing import Optional
+from PIL import Image
+import io
+
+try:
+    # registers the AVIF codec with Pillow, only needed where AVIF variants should be produced
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+# Pillow registers its format plugins lazily, load them before looking at Image.SAVE
+Image.init()
+
+# widths of the precomputed variants, requests are rounded up to the next one
+VARIANT_WIDTHS = [320, 640, 1024, 1600]
+# preferred first, AVIF is produced only when Pillow can encode it
+VARIANT_FORMATS = [fmt for fmt in ("avif", "webp") if fmt.upper() in Image.SAVE]
+VARIANT_QUALITY = {"avif": 60, "webp": 80}
+# animations and vector images are served as stored
+NON_RENDERABLE_TYPES = ["image/svg", "image/svg+xml", "image/gif", "image/ico"]
+
+
+def can_render(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith("image/") and content_type not in NON_RENDERABLE_TYPES
+
+
+def variant_width(requested: int) -> int:
+    for width in VARIANT_WIDTHS:
+        if width >= requested:
+            return width
+    return VARIANT_WIDTHS[-1]
+
+
+def variant_widths(original_width: int) -> list:
+    # the widths stored for an image, none for one narrower than them all, which is always served as stored
+    return [width for width in VARIANT_WIDTHS if width < original_width]
+
+
+def variant_format(accept: Optional[str]) -> str:
+    # the first supported format the client advertises, WebP works in every browser the SPA targets
+    accept = accept or ""
+    for fmt in VARIANT_FORMATS:
+        if f"image/{fmt}" in accept:
+            return fmt
+    return "webp"
+
+
+def render_image(data: bytes, width: int, fmt: str = "webp", quality: Optional[int] = None) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    height = max(round(width * image.height / image.width), 1)
+    # JPEGs are decoded straight at a fraction of their size, no full resolution bitmap is built
+    image.draft("RGB", (width, height))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.mode in ("P", "LA", "PA") or "transparency" in image.info else "RGB")
+    # keeps the aspect ratio and never upscales
+    image.thumbnail((width, height), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format=fmt.upper(), quality=quality or VARIANT_QUALITY[fmt])
+    return output.getvalue()
+
+
+def image_width(data: bytes) -> int:
+    # only reads the header
+    return Image.open(io.BytesIO(data)).width
@@ -1,42 +1,56 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from kheritageapi.palace import PalaceSearcher, PalaceInfo
 from kheritageapi.models import PalaceCode
-from app.db import LumaDB
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+from db import LumaDB  # noqa: E402
+
+# palace searches and building crawls of every palace share one pool, the session bounds each host
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", 32))
 
 db = LumaDB()
+db.ensure_indexes()
 palaces = [PalaceCode.GYEONGBOKGUNG, PalaceCode.CHANGDEOKGUNG, PalaceCode.CHANGGYEONGGUNG, PalaceCode.DEOKSUGUNG, PalaceCode.JONGMYO]
 
 
+def search_palace(palace):
+    search = PalaceSearcher(palace)
+    # API calls go through the same pooled, rate limited and retrying session as the media downloads
+    search.session = db.http
+    return search.perform_search()
+
+
 def save_palace_details(item):
     try:
-        palace_info = PalaceInfo(item).retrieve_details()
-        return db.save_palace(palace_info, overwrite=False)
+        palace_info = PalaceInfo(item)
+        palace_info.session = db.http
+        return db.save_palace(palace_info.retrieve_details(), overwrite=False)
     except Exception as e:
         print(f"Error saving palace details: {e}")
         return None
 
 
-for palace in palaces:
-    search = PalaceSearcher(palace)
-    items = search.perform_search()
-
-    # Define the number of threads to use
-    num_threads = 10  # Adjust this number based on your system and network capabilities
-
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        # Submit all tasks to the executor
-        future_to_item = {executor.submit(save_palace_details, item): item for item in items}
-
-        # Process the results as they complete
-        for future in as_completed(future_to_item):
-            item = future_to_item[future]
-            try:
-                result = future.result()
-                if result:
-                    print(f"Palace saved successfully: {result}")
-                else:
-                    print(f"Failed to save palace: {item}")
-            except Exception as exc:
-                print(f"Palace generated an exception: {exc}")
-
-    print("All palaces processed.")
+with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+    # all five palaces at once instead of one after another
+    items = [item for found in executor.map(search_palace, palaces) for item in found]
+    print(f"Found {len(items)} buildings")
+
+    # Submit all tasks to the executor
+    future_to_item = {executor.submit(save_palace_details, item): item for item in items}
+
+    # Process the results as they complete
+    for future in as_completed(future_to_item):
+        item = future_to_item[future]
+        try:
+            result = future.result()
+            if result:
+                print(f"Palace saved successfully: {result}")
+            else:
+                print(f"Failed to save palace: {item}")
+        except Exception as exc:
+            print(f"Palace generated an exception: {exc}")
+
+print("All palaces processed.")
@@ -1,5 +1,10 @@
 from bson import ObjectId
-from app.db import LumaDB
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from db import LumaDB  # noqa: E402
 
 db = LumaDB()
 palace_db = db.palace_db
@@ -138,8 +143,12 @@ url_slug = {
 for slug in url_slug:
     palace_db.update_one({"_id": ObjectId(slug)}, {"$set": {"url_slug": url_slug[slug]}})
 
-# create an index for slug for quick lookup with url_slug and make it unique
-palace_db.create_index("url_slug", unique=True)
+# views and cached building responses still carry the old slugs
+db.build_building_views()
+db.bump_content_version()
+
+# the unique url_slug index is part of LumaDB's index specification
+db.ensure_indexes()
 
 # using url_slug index, search for a palace with url_slug
 print(palace_db.find_one({"url_slug": "geunjeongjeon-hall"}))
\ No newline at end of file
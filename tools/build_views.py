@@ -0,0 +1,12 @@
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from db import LumaDB  # noqa: E402
+
+# rebuild the per-language building views the API reads, after restoring a backup or editing palaces by hand
+db = LumaDB()
+count = db.build_building_views()
+db.bump_content_version()
+print(f"Built views of {count} buildings")
@@ -1,5 +1,10 @@
-from app.db import LumaDB
 import re
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from db import LumaDB  # noqa: E402
 
 
 def clean_up_text(text: str) -> str:
@@ -56,3 +61,7 @@ for media in medias:
         db.media_meta_db.update_one({"_id": media["_id"]}, {"$set": {"explanation": media["explanation"]}})
 
     print(f"Updated media {media['name']['ko']} ({media['_id']})")
+
+# rewrite the views from the cleaned text and let the API drop the responses it cached from the old one
+db.build_building_views()
+db.bump_content_version()
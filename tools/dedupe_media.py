@@ -0,0 +1,81 @@
+from bson.objectid import ObjectId
+from collections import Counter
+import hashlib
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from db import LumaDB, SERVICED_LANGUAGE, INGEST_CHUNK_SIZE  # noqa: E402
+
+
+def file_sha256(db: LumaDB, file_id: ObjectId) -> str:
+    # streamed, videos are never held in memory
+    digest = hashlib.sha256()
+    media = db.media_db.get(file_id)
+    for chunk in iter(lambda: media.read(INGEST_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backfill_hashes(db: LumaDB) -> dict:
+    # the oldest copy of a body keeps the hash, returns duplicate id -> kept id
+    files = db.db["images.files"]
+    duplicates = {}
+    for file in files.find({"sha256": {"$exists": False}}, {"url": 1}, sort=[("_id", 1)]):
+        sha256 = file_sha256(db, file["_id"])
+        kept = files.find_one({"sha256": sha256}, {"_id": 1})
+        if kept:
+            duplicates[file["_id"]] = kept["_id"]
+            files.update_one({"_id": kept["_id"]}, {"$addToSet": {"aliases": file["url"]}})
+        else:
+            files.update_one({"_id": file["_id"]}, {"$set": {"sha256": sha256}, "$addToSet": {"aliases": file["url"]}})
+    return duplicates
+
+
+def merge_references(db: LumaDB, duplicate: ObjectId, kept: ObjectId) -> None:
+    db.palace_db.update_many({"thumbnail": duplicate}, {"$set": {"thumbnail": kept}})
+    for field in ("main_image", "main_video"):
+        for palace in db.palace_db.find({field: duplicate}, {field: 1}):
+            files = [kept if file_id == duplicate else file_id for file_id in palace[field]]
+            db.palace_db.update_one({"_id": palace["_id"]}, {"$set": {field: files}})
+    db.media_meta_db.update_many({"media": duplicate}, {"$set": {"media": kept}})
+    for language in SERVICED_LANGUAGE:
+        db.media_meta_db.update_many({f"video.{language}": duplicate}, {"$set": {f"video.{language}": kept}})
+
+
+def count_references(db: LumaDB) -> Counter:
+    refs = Counter()
+    for palace in db.palace_db.find({}, {"thumbnail": 1, "main_image": 1, "main_video": 1}):
+        refs.update([palace.get("thumbnail")] + palace.get("main_image", []) + palace.get("main_video", []))
+    for media in db.media_meta_db.find({}, {"media": 1, "video": 1}):
+        refs.update([media.get("media")] + list((media.get("video") or {}).values()))
+    del refs[None]
+    return refs
+
+
+def main():
+    # one-off for databases crawled before content hashing, new crawls deduplicate in LumaDB.save_file
+    db = LumaDB()
+    db.ensure_indexes()
+
+    duplicates = backfill_hashes(db)
+    for duplicate, kept in duplicates.items():
+        merge_references(db, duplicate, kept)
+        db.delete_file(duplicate)
+    print(f"Merged {len(duplicates)} duplicate files")
+
+    refs = count_references(db)
+    files = db.db["images.files"]
+    for file in files.find({}, {"_id": 1}):
+        files.update_one({"_id": file["_id"]}, {"$set": {"refs": refs[file["_id"]]}})
+    unreferenced = files.count_documents({"refs": 0})
+    print(f"Counted references of {len(refs)} files, {unreferenced} files are not referenced")
+
+    if duplicates:
+        db.build_building_views()
+        db.bump_content_version()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from pymongo.collation import Collation
+import sys
+import os
+
+# the app modules import each other as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend", "app"))
+from db import LumaDB, CONTENT_VERSION_ID  # noqa: E402
+
+
+def plan_stages(plan: dict) -> list:
+    # flatten the winning plan from the root stage down, e.g. ["PROJECTION_SIMPLE", "FETCH", "IXSCAN"]
+    stages = []
+    while plan:
+        stage = plan["stage"]
+        if "indexName" in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages
+
+
+def queries(db: LumaDB) -> list:
+    # (description, collection, filter, options) for every query the API, the crawler and the tools issue
+    palace = db.palace_db.find_one({}) or {}
+    media = db.media_meta_db.find_one({}) or {}
+    image = db.db["images.files"].find_one({}) or {}
+    language = "ko"
+    return [
+        ("building by id", db.building_view_db, {"building_id": palace.get("_id"), "language": language}, {}),
+        ("building by slug", db.building_view_db, {"url_slug": palace.get("url_slug"), "language": language}, {}),
+        ("palace elements", db.building_view_db, {"language": language, "palace_code": palace.get("palace_code")},
+         {"sort": [("element.name", 1)], "collation": Collation(locale=language)}),
+        ("navigation elements", db.building_view_db, {"language": language},
+         {"sort": [("element.name", 1)], "collation": Collation(locale=language)}),
+        ("navigation previews", db.building_view_db, {"language": language},
+         {"sort": [("palace_code", 1), ("detail_code", 1)]}),
+        ("building fallback by id", db.palace_db, {"_id": palace.get("_id")}, {}),
+        ("building fallback by slug", db.palace_db, {"url_slug": palace.get("url_slug")}, {}),
+        ("palace by serial number", db.palace_db, {"serial_number": palace.get("serial_number")}, {}),
+        ("articles with a detail image", db.palace_db, {"detail_image": media.get("_id")}, {}),
+        ("photo and video", db.media_meta_db, {"_id": media.get("_id")}, {}),
+        ("media file", db.db["images.files"], {"_id": image.get("_id")}, {}),
+        ("media file by url", db.db["images.files"], {"url": image.get("url")}, {}),
+        ("media file by alias", db.db["images.files"], {"aliases": image.get("url")}, {}),
+        ("media file by content hash", db.db["images.files"], {"sha256": image.get("sha256")}, {}),
+        ("variants of a media file", db.db["variants.files"], {"image_id": image.get("_id")}, {}),
+        ("closest variant", db.db["variants.files"], {"image_id": image.get("_id"), "format": "webp",
+                                                       "width": {"$gte": 640}}, {"sort": [("width", 1)]}),
+        ("thumbnail", db.db["thumbnails.files"], {"_id": palace.get("_id")}, {}),
+        ("content version", db.db.content_version, {"_id": CONTENT_VERSION_ID}, {}),
+    ]
+
+
+def main():
+    # read only, reports the indexes as they are; the API creates missing ones at startup
+    db = LumaDB()
+    for description, collection, query, options in queries(db):
+        explain = collection.find(query, limit=1 if "sort" not in options else 0, **options).explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        # servers running the slot based engine nest the classic plan one level deeper
+        stages = plan_stages(winning_plan.get("queryPlan", winning_plan))
+        stats = explain.get("executionStats", {})
+        warning = "  (collection scan)" if any(stage.startswith("COLLSCAN") for stage in stages) else ""
+        print(f"{description} ({collection.name}): {' <- '.join(stages)}{warning}")
+        print(f"    returned {stats.get('nReturned')}, keys examined {stats.get('totalKeysExamined')}, "
+              f"documents examined {stats.get('totalDocsExamined')}, {stats.get('executionTimeMillis')} ms")
+
+
+if __name__ == "__main__":
+    main()